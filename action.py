@@ -5,6 +5,9 @@ import jinja2
 import os
 import re
 import codecs
+import hashlib
+import json
+import sys
 from utils import confirm_action, logger
 
 
@@ -12,55 +15,121 @@ template_path="./_templates"
 template_js_file="action.js"
 template_xml_file="action.xml"
 
+# indentation removed from scripts in xml elements
+script_re = re.compile("(^|\\n)([ ]{4})")
+
+# jinja2 environment shared by all actions: templates are compiled once
+_template_env = None
+
+
+def _new_template_env(bytecode_cache=None):
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(searchpath=template_path),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False,
+        cache_size=-1)
+
+
+def get_template(name):
+    """ Returns a compiled template from the templates folder
+    """
+    global _template_env
+    if _template_env is None:
+        _template_env = _new_template_env()
+    return _template_env.get_template(name)
+
+
+def enable_bytecode_cache(directory):
+    """ Store compiled templates in directory to reuse them between runs
+    """
+    global _template_env
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    _template_env = _new_template_env(jinja2.FileSystemBytecodeCache(directory))
+
+
+def js_render_many(actions):
+    """ Returns actions rendered as js module blocks, in a single string
+    """
+    template = get_template(template_js_file)
+    return "".join(a.js_text(template) for a in actions)
+
+
+class Param():
+    """ A parameter of a vRO action
+    """
+    __slots__ = ('name', 'type', 'desc')
+
+    def __init__(self, name, type, desc=''):
+        self.name = name
+        # types and categories are shared by many actions: keep one copy
+        self.type = sys.intern(type) if type else type
+        self.desc = desc
+
+
+    def as_dict(self):
+        return {'name': self.name, 'type': self.type, 'desc': self.desc}
+
 
 class Action():
+    __slots__ = ('id', 'name', 'description', 'params', 'script', 'category', 'xml_result')
+
     def __init__(self, id, name, script, category, 
                 js_result=None, xml_result=None, 
-                description='', params=[]):
+                description='', params=()):
         self.id = id
         self.name = name
         self.description = description.strip()
-        self.params = params
+        self.params = tuple(params)
         self.script = script
-        self.category = category
+        self.category = sys.intern(category) if category else category
         if not (js_result or xml_result):
             logger.error("Missing at least one of result or xml_result to create an action.")
-        if js_result:
-            self.js_result = js_result
-            if "[]" in js_result:
-                self.xml_result = "Array/" + js_result.replace("[]", "")
-            else:
-                self.xml_result = js_result
+        # only the vRO type is stored, the js one is computed from it
+        if js_result and "[]" in js_result:
+            self.xml_result = sys.intern("Array/" + js_result.replace("[]", ""))
+        elif js_result:
+            self.xml_result = sys.intern(js_result)
         else:
-            self.xml_result = xml_result
-            if 'Array/' in xml_result:
-                self.js_result = xml_result.split('/')[1] + '[]'
-            else:
-                self.js_result = xml_result
+            self.xml_result = sys.intern(xml_result) if xml_result else xml_result
+
 
+    @property
+    def js_result(self):
+        """ Type of the result as written in the jsdoc of the action
+        """
+        if self.xml_result and 'Array/' in self.xml_result:
+            return self.xml_result.split('/')[1] + '[]'
+        return self.xml_result
 
-    def js_render(self, file):
+
+    def checksum(self):
+        """ Returns a checksum of the action content
+        """
+        content = json.dumps([self.id, self.name, self.description,
+                              [p.as_dict() for p in self.params],
+                              self.script, self.category, self.xml_result],
+                             sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+    def js_text(self, template=None):
+        """ Returns the action rendered as a js module block
+        """
         desc_as_comment = self.description.replace('\n', '\n * ')
         script = self.script.replace('\n', '\n    ')
-        templateLoader = jinja2.FileSystemLoader(searchpath=template_path)
-        templateEnv = jinja2.Environment(loader=templateLoader)
-        template = templateEnv.get_template(template_js_file)
-        outputText = template.render(action=self, 
-                                    script=script,
-                                    description=desc_as_comment)
-        with open(file, 'a') as outfile:
-            outfile.write(outputText)
-
-
-    def xml_render(self, folder):
-        script_re = re.compile("(^|\\n)([ ]{4})")
+        if template is None:
+            template = get_template(template_js_file)
+        return template.render(action=self,
+                               script=script,
+                               description=desc_as_comment)
+
+
+    def xml_data(self, template=None):
+        """ Returns the content of the xml element file of the action
+        """
         script = script_re.sub(r"\1", self.script)
-        file = os.path.join(folder, 'elements', self.id, 'data')
-        templateLoader = jinja2.FileSystemLoader(searchpath=template_path)
-        templateEnv = jinja2.Environment(loader=templateLoader)
-        template = templateEnv.get_template(template_xml_file)
+        if template is None:
+            template = get_template(template_xml_file)
         outputText = template.render(action=self, script=script)
-        with open(file, 'w', encoding="utf-16-be") as outfile:
-            outfile.write('\ufeff')
-            outfile.write(outputText)  # .encode('utf-16-be')
-
+        return ('\ufeff' + outputText).encode('utf-16-be')
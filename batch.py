@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import click
+from utils import logger
+
+
+class Transfer():
+    """ A single push or pull of a package against a vRO server
+    """
+    def __init__(self, direction, package, server, force=False, check_remote=False):
+        self.direction = direction
+        self.package = package
+        self.server = server
+        self.force = force
+        self.check_remote = check_remote
+        self.status = 'pending'
+        self.duration = 0
+        self.size = 0
+
+    def run(self, retries=0, backoff=2):
+        if self.direction == 'push':
+            if self.server.push(self.package.name, self.package.build,
+                                self.force, self.check_remote, retries, backoff):
+                self.size = os.path.getsize(self.package.build)
+            else:
+                self.status = 'skipped'
+        else:
+            self.server.pull(self.package.name, self.package.src_package)
+            self.size = os.path.getsize(self.package.src_package)
+
+
+def run_transfers(transfers, jobs=4, per_server=2, retries=2, backoff=2):
+    """ Run transfers on a bounded thread pool
+
+    At most per_server transfers are run at the same time against a given
+    server. The uploads of the pushes are retried with an exponential
+    backoff; the pulls are already retried by VroServer (the session retries
+    the requests and the interrupted downloads are resumed).
+    """
+    locks = {}
+    for t in transfers:
+        locks.setdefault(t.server.hostname, threading.BoundedSemaphore(per_server))
+
+    def _run(transfer):
+        start = time.time()
+        try:
+            with locks[transfer.server.hostname]:
+                transfer.run(retries, backoff)
+            if transfer.status != 'skipped':
+                transfer.status = 'ok'
+        # VroServer exits on HTTP errors: catch it to run the other transfers
+        except (Exception, SystemExit) as e:
+            transfer.status = 'failed'
+            # the reason of an exit is already logged by VroServer
+            logger.error("%s of %s on %s failed%s" % (transfer.direction,
+                transfer.package.name, transfer.server.hostname,
+                "" if isinstance(e, SystemExit) else ": %s" % e))
+        transfer.duration = time.time() - start
+        return transfer
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        done = list(executor.map(_run, transfers))
+    print_summary(done)
+    return all(t.status in ('ok', 'skipped') for t in done)
+
+
+def print_summary(transfers):
+    """ Print a summary table of transfers
+    """
+    header = ('Package', 'Server', 'Direction', 'Status', 'Time (s)', 'Bytes')
+    rows = [(t.package.name, t.server.hostname, t.direction, t.status,
+             "%.2f" % t.duration, str(t.size)) for t in transfers]
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+    line = "  ".join("%%-%ds" % w for w in widths)
+    click.echo(line % header)
+    click.echo(line % tuple('-' * w for w in widths))
+    for r in rows:
+        click.echo(line % r)
+    total = sum(t.size for t in transfers)
+    click.echo("%d transfer(s), %d skipped, %d failed, %d bytes moved" % (len(transfers),
+        len([t for t in transfers if t.status == 'skipped']),
+        len([t for t in transfers if t.status == 'failed']), total))
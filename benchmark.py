@@ -0,0 +1,823 @@
+#!/usr/bin/env python
+
+""" Benchmarks of the vRO CLI build/expand/push/pull stages
+
+Synthetic packages and module trees are generated in a temporary folder,
+each stage is run in a fresh process (so its peak RSS can be measured) and
+results are saved as JSON to be compared between runs.
+"""
+
+import os
+import json
+import time
+import re
+import uuid
+import hashlib
+import shutil
+import subprocess
+import sys
+import platform
+import tempfile
+import threading
+import zipfile
+import multiprocessing
+import http.server
+import urllib.parse
+import click
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# templates are looked up relatively to the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# number of lines of the generated action scripts
+SCRIPT_SIZES = {'small': 5, 'medium': 50, 'huge': 2000}
+# number of actions per generated module
+ACTIONS_PER_MODULE = 50
+PACKAGE_NAME = 'io.vuptime.vrocli.benchmark'
+STAGES = ['expand', 'extract', 'build', 'push', 'pull']
+# CLI commands timed by the startup benchmark
+STARTUP_COMMANDS = ['--version', 'list packages']
+
+
+def synthetic_actions(count, script_lines):
+    """ Returns count synthetic actions with scripts of script_lines lines
+    """
+    from action import Action, Param
+    script = "\n".join("var v%d = input + %d;\nif (v%d > 0) {\n    System.log(v%d);\n}"
+                       % (i, i, i, i) for i in range(script_lines // 4 + 1))
+    actions = []
+    for i in range(count):
+        actions.append(Action(
+            id=str(uuid.UUID(int=i + 1)),
+            name='action%d' % i,
+            description='Synthetic action %d\nused by benchmarks' % i,
+            params=[Param('input', 'number', 'an input'),
+                    Param('names', 'Array/string')],
+            script=script + "\nreturn v0;",
+            category='io.vuptime.benchmark.module%d' % (i // ACTIONS_PER_MODULE),
+            xml_result='string'
+        ))
+    return actions
+
+
+def generate_package(actions, package_file):
+    """ Write a .package file with the actions, like the ones exported by vRO
+    """
+    from action import get_template, template_xml_file
+    template = get_template(template_xml_file)
+    with zipfile.ZipFile(package_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr('dunes-meta-inf', 'pkg-name=%s\n' % PACKAGE_NAME)
+        for a in actions:
+            zipf.writestr('elements/%s/info' % a.id, 'type=ScriptModule\nid=%s\n' % a.id)
+            zipf.writestr('elements/%s/categories' % a.id,
+                "<?xml version='1.0' encoding='UTF-8'?>\n<categories><category name='%s'>"
+                "<name><![CDATA[%s]]></name></category></categories>" % (a.category, a.category))
+            zipf.writestr('elements/%s/data' % a.id, a.xml_data(template))
+
+
+def generate_modules(actions, path):
+    """ Write the /** @module */ js files of the actions in path
+    """
+    from action import js_render_many
+    if not os.path.exists(path):
+        os.makedirs(path)
+    modules = {}
+    for a in actions:
+        modules.setdefault(a.category, []).append(a)
+    for category, module_actions in modules.items():
+        with open(os.path.join(path, category + '.js'), 'w') as outfile:
+            outfile.write("/** @module " + category + " */\n\n" +
+                          js_render_many(module_actions))
+
+
+def bench_config(workdir, port, compression='default', log_level='WARNING'):
+    """ Returns a vRO CLI configuration using workdir and the mock server
+    """
+    return {
+        'log_level': log_level,
+        'compression': compression,
+        # keep the files of the CLI out of the source tree
+        'cache_dir': os.path.join(workdir, '.vrocli-cache'),
+        'state_file': os.path.join(workdir, '.vrocli-state.json'),
+        'inventory_file': os.path.join(workdir, '.vrocli-inventory.db'),
+        'default_paths': {
+            'packages': os.path.join(workdir, 'packages') + os.sep,
+            'expand_target': os.path.join(workdir, 'unzip') + os.sep,
+            'build_target': os.path.join(workdir, 'builds') + os.sep,
+            'working_dir': os.path.join(workdir, 'src') + os.sep,
+        },
+        'packages': {PACKAGE_NAME: {}},
+        'vro_servers': {
+            'localhost:%d' % port: {
+                'user': 'benchmark',
+                'pwd': 'benchmark',
+                'protocol': 'http',
+            }
+        }
+    }
+
+
+def action_content(action, version):
+    """ Returns the content of an action as sent by the vRO API
+    """
+    return {
+        'id': action.id,
+        'name': action.name,
+        'module': action.category,
+        'version': version,
+        'description': action.description,
+        'input-parameters': [{'name': p.name, 'type': p.type, 'description': p.desc}
+                             for p in action.params],
+        'output-type': action.xml_result,
+        'script': action.script,
+    }
+
+
+def package_etag(data):
+    """ Returns the ETag the mock server sends for a package content
+    """
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+class MockVroHandler(http.server.BaseHTTPRequestHandler):
+    """ Minimal vRO packages API: serves (with ETag, conditional and Range
+    requests) and accepts package files, and serves the pages of the
+    catalog and the content of the actions
+
+    Requests with credentials open a session (JSESSIONID cookie), the other
+    ones are refused if their session is unknown.
+    """
+    protocol_version = 'HTTP/1.1'
+    package_file = None
+    # (path, Range header, status, content type) of the GET requests served
+    served = None
+    # ids of the open sessions, and paths of the requests with credentials
+    sessions = None
+    logins = None
+    session_cookie = None
+    # attributes of the catalog items by type, and content of the actions
+    # by id
+    catalog = None
+    actions = None
+    # statuses answered to the next uploads (before accepting them), and
+    # (size, status) of the uploads received
+    upload_failures = None
+    uploads = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authenticated(self):
+        self.session_cookie = None
+        if self.headers.get('Authorization', '').startswith('Basic '):
+            session_id = uuid.uuid4().hex
+            self.sessions.add(session_id)
+            self.logins.append(self.path)
+            self.session_cookie = 'JSESSIONID=%s; Path=/' % session_id
+            return True
+        cookie = re.search(r'JSESSIONID=(\w+)', self.headers.get('Cookie', ''))
+        if cookie and cookie.group(1) in self.sessions:
+            return True
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', 'Basic realm="vCO"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def end_headers(self):
+        if self.session_cookie:
+            self.send_header('Set-Cookie', self.session_cookie)
+        super().end_headers()
+
+    def _send_json(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        if self.served is not None:
+            self.served.append((self.path, None, status, 'application/json'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_catalog(self, item_type, query):
+        items = (self.catalog or {}).get(item_type, [])
+        start = int(query.get('startIndex', ['0'])[0])
+        count = int(query.get('maxResult', [str(len(items))])[0])
+        self._send_json(200, {
+            'link': [{'attributes': [{'name': k, 'value': v} for k, v in item.items()]}
+                     for item in items[start:start + count]],
+            'total': len(items),
+        })
+
+    def do_GET(self):
+        if not self._authenticated():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/vco/api/catalog/System/'):
+            self._send_catalog(url.path.rsplit('/', 1)[1], urllib.parse.parse_qs(url.query))
+            return
+        if url.path.startswith('/vco/api/actions/'):
+            action_id = url.path.rsplit('/', 1)[1]
+            if action_id in (self.actions or {}):
+                self._send_json(200, self.actions[action_id])
+            else:
+                self._send_json(404, {})
+            return
+        with open(self.package_file, 'rb') as infile:
+            data = infile.read()
+        etag = package_etag(data)
+        if 'application/json' in self.headers.get('Accept', ''):
+            # description of the package, its version changes with its content
+            self._send_json(200, {'name': url.path.rsplit('/', 1)[1],
+                                  'version': etag.strip('"')})
+            return
+        rng = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if self.headers.get('If-None-Match') == etag:
+            status = 304
+            data = b''
+        elif rng and self.headers.get('If-Range', etag) == etag and \
+                int(rng.group(1)) < len(data):
+            status = 206
+            start = int(rng.group(1))
+            content_range = 'bytes %d-%d/%d' % (start, len(data) - 1, len(data))
+            data = data[start:]
+        else:
+            # no range, or the package changed since the If-Range validator
+            status = 200
+        if self.served is not None:
+            self.served.append((self.path, self.headers.get('Range'), status,
+                                'application/zip'))
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', content_range)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        size = remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        if not self._authenticated():
+            return
+        status = self.upload_failures.pop(0) if self.upload_failures else 202
+        self.uploads.append((size, status))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def start_mock_server(package_file, served=None, catalog=None, actions=None):
+    """ Start a mock vRO server in a thread, returns the server
+
+    The GET requests are recorded in the served list, if set. The catalog
+    and actions dicts can be changed while the server runs.
+    """
+    handler = type('Handler', (MockVroHandler,), {'package_file': package_file,
+                                                  'served': served,
+                                                  'sessions': set(), 'logins': [],
+                                                  'catalog': catalog, 'actions': actions,
+                                                  'upload_failures': [], 'uploads': []})
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _stage_worker(stage, config, queue):
+    """ Run a stage in the current (fresh) process and report its metrics
+    """
+    if config['log_level'] != 'WARNING':
+        # discard the console output, only its cost matters
+        sys.stderr = open(os.devnull, 'w')
+    try:
+        queue.put(_run_stage(stage, config))
+    except BaseException as e:
+        queue.put({'error': repr(e)})
+
+
+def _run_stage(stage, config):
+    import utils
+    from utils import logger, list_modules, extract_actions_from_modules
+    from config import compile_config
+    from package import Package
+    from vroserver import VroServer
+    config = compile_config(config)
+    logger.setLevel(config.log_level)
+    p = Package(PACKAGE_NAME, config)
+    server = list(config.vro_servers)[0]
+    start = time.time()
+    if stage == 'expand':
+        p.expand()
+        size = os.path.getsize(p.src_package)
+    elif stage == 'extract':
+        modules = list_modules(p.wd)
+        extract_actions_from_modules(modules)
+        size = sum(len("".join(m[1])) for m in modules)
+    elif stage == 'build':
+        p.rebuild(extract_actions_from_modules(list_modules(p.wd)))
+        size = os.path.getsize(p.build)
+    elif stage == 'push':
+        VroServer(server, config).push(p.name, p.build)
+        size = os.path.getsize(p.build)
+    elif stage == 'pull':
+        destination = p.src_package + '.pulled'
+        VroServer(server, config).pull(p.name, destination)
+        size = os.path.getsize(destination)
+    # wait for the queued log records to be written
+    getattr(utils, 'flush_logging', lambda: None)()
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    return {'seconds': elapsed, 'peak_rss_kb': peak_rss, 'bytes': size}
+
+
+def run_stage(stage, config):
+    """ Run a stage in a new process and returns its metrics
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_stage_worker, args=(stage, config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise click.ClickException("Stage %s failed: %s" % (stage, result['error']))
+    return result
+
+
+@click.group()
+def benchmark():
+    """ Benchmarks of the vRO CLI stages
+    """
+
+
+@benchmark.command('run')
+@click.option('-n', '--sizes', default='10,100,1000', metavar='<list>',
+    help="Comma separated numbers of actions of the generated packages")
+@click.option('--script', type=click.Choice(sorted(SCRIPT_SIZES)), default='small',
+    help="Size of the generated action scripts")
+@click.option('--stages', default=','.join(STAGES), metavar='<list>',
+    help="Comma separated stages to run")
+@click.option('-o', '--output', metavar='<file>',
+    help="JSON file where to save the results")
+@click.option('-z', '--compression', type=click.Choice(['store', 'fast', 'default', 'max']),
+    default='default', help="Compression of the built packages")
+@click.option('-l', '--log-level', default='WARNING', metavar='<level>',
+    help="Log level of the stages (their console output is discarded)")
+@click.option('--keep', is_flag=True, default=False,
+    help="Keep the generated files")
+def run(sizes, script, stages, compression, log_level, output, keep):
+    """ Generate synthetic packages and time each stage on them
+    """
+    stages = [s for s in STAGES if s in stages.split(',')]
+    results = []
+    for count in [int(n) for n in sizes.split(',')]:
+        workdir = tempfile.mkdtemp(prefix='vrocli-bench-')
+        try:
+            actions = synthetic_actions(count, SCRIPT_SIZES[script])
+            package_file = os.path.join(workdir, 'packages', PACKAGE_NAME + '.package')
+            os.makedirs(os.path.dirname(package_file))
+            generate_package(actions, package_file)
+            if 'expand' not in stages:
+                generate_modules(actions, os.path.join(workdir, 'src', PACKAGE_NAME))
+            if 'build' not in stages:
+                os.makedirs(os.path.join(workdir, 'builds'))
+                shutil.copy(package_file, os.path.join(workdir, 'builds', PACKAGE_NAME + '.package'))
+            del actions
+            server = start_mock_server(package_file)
+            config = bench_config(workdir, server.server_address[1], compression,
+                                  log_level)
+            for stage in stages:
+                result = run_stage(stage, config)
+                result.update({
+                    'stage': stage,
+                    'actions': count,
+                    'script': script,
+                    'items_per_s': (1 if stage in ('push', 'pull') else count) / result['seconds'],
+                    'mb_per_s': result['bytes'] / 1048576.0 / result['seconds'],
+                })
+                results.append(result)
+                click.echo("%6d actions  %-8s %8.3f s  %8.1f items/s  %8.2f MB/s  %s KB peak RSS"
+                    % (count, stage, result['seconds'], result['items_per_s'],
+                       result['mb_per_s'], result['peak_rss_kb']))
+            server.shutdown()
+        finally:
+            if keep:
+                click.echo("Generated files kept in %s" % workdir)
+            else:
+                shutil.rmtree(workdir)
+    if output:
+        with open(output, 'w') as outfile:
+            json.dump({
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': multiprocessing.cpu_count(),
+                'results': results
+            }, outfile, indent=2)
+        click.echo("Results saved in %s" % output)
+
+
+def time_startup(args, workdir):
+    """ Run the CLI once with -X importtime, returns the elapsed time, the
+    time spent in imports and the cumulative import time of each top-level
+    module (in seconds)
+    """
+    command = [sys.executable, '-X', 'importtime', os.path.abspath('vrocli.py')] + args
+    start = time.time()
+    p = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.time() - start
+    if p.returncode:
+        raise click.ClickException("vrocli %s failed:\n%s" % (" ".join(args), p.stderr))
+    imports = 0
+    modules = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports += int(self_us)
+        if not name.startswith('  '):  # top-level import
+            modules[name.strip()] = int(cumulative_us) / 1e6
+    return elapsed, imports / 1e6, modules
+
+
+@benchmark.command('startup')
+@click.option('-c', '--command', 'commands', multiple=True, metavar='<string>',
+    help="Command line to time (default: %s)" % ", ".join(STARTUP_COMMANDS))
+@click.option('-r', '--runs', default=10, metavar='<int>',
+    help="Number of runs of each command")
+@click.option('-o', '--output', metavar='<file>',
+    help="JSON file where to save the results")
+def startup(commands, runs, output):
+    """ Time the startup of the CLI and its imports with python -X importtime
+    """
+    workdir = tempfile.mkdtemp(prefix='vrocli-bench-')
+    results = []
+    try:
+        import yaml
+        with open(os.path.join(workdir, '.vrocli.yml'), 'w') as outfile:
+            yaml.safe_dump({'vrocli': bench_config(workdir, 8443)}, outfile)
+        for command in commands or STARTUP_COMMANDS:
+            runs_times = sorted((time_startup(command.split(), workdir) for _ in range(runs)),
+                                key=lambda r: r[0])
+            elapsed, imports, modules = runs_times[len(runs_times) // 2]
+            results.append({
+                'stage': 'startup',
+                'command': command,
+                'actions': 0,
+                'script': command,
+                'seconds': elapsed,
+                'import_seconds': imports,
+                'modules': modules
+            })
+            slowest = sorted(modules.items(), key=lambda m: -m[1])[:5]
+            click.echo("%-20s %8.3f s  %8.3f s in imports  (%s)" % (command, elapsed, imports,
+                ", ".join("%s %.3f" % m for m in slowest)))
+    finally:
+        shutil.rmtree(workdir)
+    if output:
+        with open(output, 'w') as outfile:
+            json.dump({
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': multiprocessing.cpu_count(),
+                'results': results
+            }, outfile, indent=2)
+        click.echo("Results saved in %s" % output)
+
+
+def _logging_worker(count, workdir, queue):
+    """ Log count INFO records, like the former line per package element,
+    in the current (fresh) process and report the time spent
+    """
+    try:
+        os.chdir(workdir)
+        sys.stderr = open(os.devnull, 'w')
+        import logging
+        import utils
+        utils.logger.setLevel(logging.INFO)
+        start = time.time()
+        for i in range(count):
+            utils.logger.info("Unboxing item with id %s" % uuid.UUID(int=i))
+        caller = time.time() - start
+        getattr(utils, 'flush_logging', lambda: None)()
+        queue.put({'seconds': time.time() - start, 'caller_seconds': caller})
+    except BaseException as e:
+        queue.put({'error': repr(e)})
+
+
+@benchmark.command('logging')
+@click.option('-n', '--records', default=100000, metavar='<int>',
+    help="Number of records logged")
+@click.option('-r', '--runs', default=3, metavar='<int>',
+    help="Number of runs")
+@click.option('-o', '--output', metavar='<file>',
+    help="JSON file where to save the results")
+def logging_(records, runs, output):
+    """ Time the logging of records to the console and vrocli.log outputs
+    """
+    workdir = tempfile.mkdtemp(prefix='vrocli-bench-')
+    ctx = multiprocessing.get_context('spawn')
+    runs_results = []
+    try:
+        for _ in range(runs):
+            queue = ctx.Queue()
+            process = ctx.Process(target=_logging_worker, args=(records, workdir, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if 'error' in result:
+                raise click.ClickException("Logging failed: %s" % result['error'])
+            runs_results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    result = sorted(runs_results, key=lambda r: r['seconds'])[len(runs_results) // 2]
+    result.update({'stage': 'logging', 'actions': records, 'script': 'info',
+                   'items_per_s': records / result['seconds']})
+    click.echo("%d records  %8.3f s  %8.3f s in the caller  %10.1f records/s"
+        % (records, result['seconds'], result['caller_seconds'], result['items_per_s']))
+    if output:
+        with open(output, 'w') as outfile:
+            json.dump({
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': multiprocessing.cpu_count(),
+                'results': [result]
+            }, outfile, indent=2)
+        click.echo("Results saved in %s" % output)
+
+
+def check_resumed_pulls(workdir):
+    """ Pull a package over part files left by interrupted downloads: of the
+    same package (resumed), of a previous version of the package and
+    without validators (both downloaded again)
+    """
+    import logging
+    from utils import logger
+    from config import compile_config
+    from vroserver import VroServer
+    logger.setLevel(logging.WARNING)
+    package_file = os.path.join(workdir, 'server.package')
+    generate_package(synthetic_actions(200, SCRIPT_SIZES['medium']), package_file)
+    previous_file = os.path.join(workdir, 'previous.package')
+    generate_package(synthetic_actions(200, SCRIPT_SIZES['small']), previous_file)
+    with open(package_file, 'rb') as infile:
+        data = infile.read()
+    with open(previous_file, 'rb') as infile:
+        previous = infile.read()
+    served = []
+    server = start_mock_server(package_file, served)
+    try:
+        config = compile_config(bench_config(workdir, server.server_address[1]))
+        v = VroServer(list(config.vro_servers)[0], config)
+        destination = os.path.join(workdir, 'pulled.package')
+        for case, part, etag, expected in (
+                ('resumed part file', data[:len(data) // 2], package_etag(data), 206),
+                ('part file of a previous version', previous[:len(data) // 2],
+                 package_etag(previous), 200),
+                ('part file without validators', data[:len(data) // 2], None, 200)):
+            with open(destination + '.part', 'wb') as outfile:
+                outfile.write(part)
+            if etag:
+                with open(destination + '.part.validators', 'w') as outfile:
+                    json.dump([etag, None], outfile)
+            del served[:]
+            v.pull(PACKAGE_NAME, destination)
+            with open(destination, 'rb') as infile:
+                pulled = infile.read()
+            if pulled != data:
+                raise click.ClickException("%s: pulled package differs" % case)
+            if [s[2] for s in served if s[3] == 'application/zip'] != [expected]:
+                raise click.ClickException("%s: expected a %d response, got %s"
+                                           % (case, expected, served))
+            click.echo("ok  %s (HTTP %d)" % (case, expected))
+    finally:
+        server.shutdown()
+
+
+def check_push_retries(workdir):
+    """ Push a package in batch mode to a server failing the first uploads:
+    the upload must be sent again (whole) until the retries are exhausted
+    """
+    import logging
+    from utils import logger
+    from config import compile_config
+    from package import Package
+    from vroserver import VroServer
+    from batch import Transfer
+    logger.setLevel(logging.CRITICAL)
+    package_file = os.path.join(workdir, 'push.package')
+    generate_package(synthetic_actions(200, SCRIPT_SIZES['medium']), package_file)
+    server = start_mock_server(package_file)
+    handler = server.RequestHandlerClass
+    try:
+        config = compile_config(bench_config(workdir, server.server_address[1]))
+        p = Package(PACKAGE_NAME, config)
+        p.build = package_file
+        v = VroServer(list(config.vro_servers)[0], config)
+        for case, failures, expected in (('503 then accepted', [503], 'ok'),
+                                         ('503 until the retries are exhausted',
+                                          [503, 502, 504], 'failed')):
+            handler.upload_failures[:] = failures
+            del handler.uploads[:]
+            transfer = Transfer('push', p, v, force=True)
+            try:
+                transfer.run(retries=2, backoff=0)
+                status = 'ok'
+            except SystemExit:
+                status = 'failed'
+            sizes = set(u[0] for u in handler.uploads)
+            if status != expected or len(handler.uploads) != min(len(failures) + 1, 3) or \
+                    len(sizes) != 1:
+                raise click.ClickException("%s: transfer %s after uploads %s" %
+                                           (case, status, handler.uploads))
+            click.echo("ok  %s (%d upload(s), transfer %s)" % (case, len(handler.uploads), status))
+    finally:
+        server.shutdown()
+
+
+def check_push_skip(workdir):
+    """ Push an unchanged package: it must be skipped, unless check_remote
+    is set and the package was changed on the server since
+    """
+    import logging
+    from utils import logger
+    from config import compile_config
+    from vroserver import VroServer
+    logger.setLevel(logging.WARNING)
+    package_file = os.path.join(workdir, 'skip.package')
+    generate_package(synthetic_actions(100, SCRIPT_SIZES['small']), package_file)
+    changed_file = os.path.join(workdir, 'skip-changed.package')
+    generate_package(synthetic_actions(101, SCRIPT_SIZES['small']), changed_file)
+    server = start_mock_server(package_file)
+    handler = server.RequestHandlerClass
+    try:
+        config = compile_config(bench_config(workdir, server.server_address[1]))
+        v = VroServer(list(config.vro_servers)[0], config)
+        for case, server_file, check_remote, expected in (
+                ('first push', package_file, False, True),
+                ('unchanged package', package_file, False, False),
+                ('unchanged package on the server', package_file, True, False),
+                ('package changed on the server, local state only', changed_file, False, False),
+                ('package changed on the server', changed_file, True, True)):
+            handler.package_file = server_file
+            pushed = v.push(PACKAGE_NAME, package_file, check_remote=check_remote)
+            if pushed != expected:
+                raise click.ClickException("%s: package %s" %
+                                           (case, "pushed" if pushed else "skipped"))
+            click.echo("ok  %s (%s)" % (case, "pushed" if pushed else "skipped"))
+    finally:
+        server.shutdown()
+
+
+def check_session_auth(workdir):
+    """ Pull and push a package: the credentials must only be sent until the
+    server opens a session, and again once the session expired
+    """
+    import logging
+    from utils import logger
+    from config import compile_config
+    from vroserver import VroServer
+    logger.setLevel(logging.WARNING)
+    package_file = os.path.join(workdir, 'session.package')
+    generate_package(synthetic_actions(200, SCRIPT_SIZES['medium']), package_file)
+    server = start_mock_server(package_file)
+    handler = server.RequestHandlerClass
+    try:
+        config = compile_config(bench_config(workdir, server.server_address[1]))
+        v = VroServer(list(config.vro_servers)[0], config)
+        destination = os.path.join(workdir, 'session-pulled.package')
+        for case, expire, logins in (('first pull', False, 1), ('pull in session', False, 1),
+                                     ('push in session', False, 1),
+                                     ('push after the session expired', True, 2),
+                                     ('pull after the session expired', True, 3)):
+            if expire:
+                handler.sessions.clear()
+            if case.startswith('push'):
+                v.push(PACKAGE_NAME, package_file, force=True)
+            else:
+                v.pull(PACKAGE_NAME, destination)
+            if len(handler.logins) != logins:
+                raise click.ClickException("%s: credentials sent %d time(s), expected %d"
+                                           % (case, len(handler.logins), logins))
+            click.echo("ok  %s (credentials sent %d time(s))" % (case, logins))
+    finally:
+        server.shutdown()
+
+
+def check_inventory_refresh(workdir):
+    """ Refresh an inventory twice: the catalog must be read page by page and
+    only the actions added or with a new version fetched again
+    """
+    import logging
+    from utils import logger
+    from config import compile_config
+    from vroserver import VroServer
+    from inventory import Inventory, action_checksum
+    logger.setLevel(logging.WARNING)
+    package_file = os.path.join(workdir, 'inventory.package')
+    actions = synthetic_actions(251, SCRIPT_SIZES['small'])
+    generate_package(actions[:10], package_file)
+    contents = dict((a.id, action_content(a, '1.0.0')) for a in actions[:250])
+    catalog = {
+        'Action': [_catalog_attributes(c) for c in contents.values()],
+        'Package': [{'id': str(uuid.UUID(int=i + 1000)), 'name': 'package%d' % i,
+                     'version': '1.0.0'} for i in range(3)],
+    }
+    served = []
+    server = start_mock_server(package_file, served, catalog, contents)
+    inv = Inventory(os.path.join(workdir, 'inventory.db'))
+
+    def _refresh(case, expected, fetched):
+        del served[:]
+        counts = inv.refresh(v, jobs=4, page_size=100)
+        if counts != expected:
+            raise click.ClickException("%s: %d listed, %d fetched and %d packages, "
+                                       "expected %d, %d and %d" % ((case,) + counts + expected))
+        got = set(s[0].rsplit('/', 1)[1] for s in served if '/actions/' in s[0])
+        if got != fetched:
+            raise click.ClickException("%s: %d unexpected action(s) fetched"
+                                       % (case, len(got ^ fetched)))
+        pages = sorted(int(urllib.parse.parse_qs(urllib.parse.urlsplit(s[0]).query)
+                           ['startIndex'][0]) for s in served if 'System/Action' in s[0])
+        if pages != list(range(0, expected[0], 100)):
+            raise click.ClickException("%s: unexpected catalog pages %s" % (case, pages))
+        for action_id, content in contents.items():
+            rows = inv.find_action(action_id)
+            if len(rows) != 1 or rows[0]['checksum'] != action_checksum(content):
+                raise click.ClickException("%s: wrong checksum of %s" % (case, action_id))
+        click.echo("ok  %s (%d action(s) listed in %d page(s), %d fetched)"
+                   % (case, expected[0], len(pages), len(got)))
+
+    try:
+        config = compile_config(bench_config(workdir, server.server_address[1]))
+        v = VroServer(list(config.vro_servers)[0], config)
+        _refresh('first refresh', (250, 250, 3), set(contents))
+        # new version of 5 actions, 2 actions removed and 1 added
+        changed = [a.id for a in actions[:5]]
+        for action_id in changed:
+            contents[action_id]['version'] = '1.0.1'
+            contents[action_id]['script'] += '\nSystem.log("1.0.1");'
+        removed = [a.id for a in actions[5:7]]
+        for action_id in removed:
+            del contents[action_id]
+        contents[actions[250].id] = action_content(actions[250], '1.0.0')
+        catalog['Action'] = [_catalog_attributes(c) for c in contents.values()]
+        _refresh('second refresh', (249, 6, 3), set(changed + [actions[250].id]))
+        if any(inv.find_action(action_id) for action_id in removed):
+            raise click.ClickException("second refresh: removed actions still indexed")
+    finally:
+        inv.close()
+        server.shutdown()
+
+
+def _catalog_attributes(content):
+    return dict((k, content[k]) for k in ('id', 'name', 'module', 'version'))
+
+
+@benchmark.command('check')
+def check():
+    """ Check the transfers against the mock server
+    """
+    workdir = tempfile.mkdtemp(prefix='vrocli-check-')
+    try:
+        check_resumed_pulls(workdir)
+        check_push_retries(workdir)
+        check_push_skip(workdir)
+        check_session_auth(workdir)
+        check_inventory_refresh(workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+@benchmark.command('compare')
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+def compare(before, after):
+    """ Compare the results of two benchmark runs
+    """
+    def _index(run):
+        return dict(((r['stage'], r['actions'], r['script']), r)
+                    for r in json.load(run)['results'])
+    before, after = _index(before), _index(after)
+    click.echo("%-8s %8s %-7s %10s %10s %8s" % ('stage', 'actions', 'script',
+                                              'before (s)', 'after (s)', 'speedup'))
+    order = STAGES + ['startup', 'logging']
+    for key in sorted(set(before) & set(after), key=lambda k: (k[1], order.index(k[0]), k[2])):
+        b, a = before[key]['seconds'], after[key]['seconds']
+        click.echo("%-8s %8d %-7s %10.3f %10.3f %7.2fx" % (key[0], key[1], key[2],
+                                                       b, a, b / a if a else 0))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import shutil
+import threading
+from utils import logger
+
+# caches shared by all the VroServer objects, by folder
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(config):
+    """ Returns the packages cache configured in config (None if disabled)
+    """
+    path = config.cache_dir
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = PackageCache(path, config.cache_size)
+        return _caches[path]
+
+
+class PackageCache():
+    """ Content-addressed cache of the packages downloaded from servers
+
+    Package files are stored by sha256, with the validators (ETag and
+    Last-Modified) returned by the server they came from. The least
+    recently used files are evicted when the cache exceeds max_size MB.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.index_file = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.index = {'blobs': {}, 'entries': {}}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as infile:
+                try:
+                    self.index = json.load(infile)
+                except ValueError:
+                    logger.warning("Invalid cache index %s, ignoring it" % self.index_file)
+
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, sha256 + '.package')
+
+
+    def lookup(self, server, package):
+        """ Returns the cache entry of a package of a server (None if unknown)
+
+        An entry is a dict with the sha256 of the package and the ETag and
+        Last-Modified validators sent by the server.
+        """
+        with self.lock:
+            entry = self.index['entries'].get("%s/%s" % (server, package))
+            if not entry or not os.path.isfile(self.blob_path(entry['sha256'])):
+                return None
+            self.index['blobs'][entry['sha256']]['last_used'] = time.time()
+            self._save()
+            return entry
+
+
+    def add(self, server, package, package_file, sha256, etag=None, last_modified=None):
+        """ Store a downloaded package file and its validators
+        """
+        with self.lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            blob = self.blob_path(sha256)
+            if not os.path.isfile(blob):
+                shutil.copyfile(package_file, blob + '.tmp')
+                os.replace(blob + '.tmp', blob)
+            self.index['blobs'][sha256] = {'size': os.path.getsize(blob),
+                                           'last_used': time.time()}
+            self.index['entries']["%s/%s" % (server, package)] = {
+                'sha256': sha256,
+                'etag': etag,
+                'last_modified': last_modified
+            }
+            self._evict()
+            self._save()
+
+
+    def _evict(self):
+        """ Remove the least recently used packages above the cache size
+        """
+        blobs = self.index['blobs']
+        total = sum(b['size'] for b in blobs.values())
+        for sha256 in sorted(blobs, key=lambda s: blobs[s]['last_used']):
+            if total <= self.max_size:
+                break
+            logger.debug("Evicting package %s from cache" % sha256)
+            total -= blobs.pop(sha256)['size']
+            if os.path.isfile(self.blob_path(sha256)):
+                os.remove(self.blob_path(sha256))
+            for key in [k for k, e in self.index['entries'].items() if e['sha256'] == sha256]:
+                del self.index['entries'][key]
+
+
+    def _save(self):
+        with open(self.index_file + '.tmp', 'w') as outfile:
+            json.dump(self.index, outfile)
+        os.replace(self.index_file + '.tmp', self.index_file)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+from utils import logger
+
+# default configuration file
+CONFIG_FILE = '.vrocli.yml'
+# version of the compiled configuration objects: snapshots of an other
+# version are ignored
+SNAPSHOT_VERSION = 5
+
+# default location of the deployment state file
+DEFAULT_STATE_FILE = '.vrocli-state.json'
+# default location of the inventory of the servers
+DEFAULT_INVENTORY_FILE = '.vrocli-inventory.db'
+# default location and size (in MB) of the downloaded packages cache
+DEFAULT_CACHE_DIR = '.vrocli-cache'
+DEFAULT_CACHE_SIZE = 1024
+# default settings of the vRO servers
+DEFAULT_PROTOCOL = 'https'
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 10
+# default (connect, read) timeouts in seconds of HTTP requests
+DEFAULT_TIMEOUT = (10, 300)
+# compression modes of the built packages
+COMPRESSION_MODES = ('store', 'fast', 'default', 'max')
+DEFAULT_COMPRESSION = 'default'
+
+PACKAGE_KEYS = ('package', 'expand_target', 'build_target', 'working_dir', 'compression')
+SERVER_KEYS = ('user', 'pwd', 'verify_ssl', 'protocol', 'retries', 'pool_size', 'timeout')
+
+
+class PackageConfig():
+    """ Paths of a configured package (defaults already applied)
+    """
+    __slots__ = ('name',) + PACKAGE_KEYS
+
+    def __init__(self, name, package, expand_target, build_target, working_dir,
+                 compression=None):
+        self.name = name
+        self.package = package
+        self.expand_target = expand_target
+        self.build_target = build_target
+        self.working_dir = working_dir
+        # None to use the default compression of the configuration
+        self.compression = compression
+
+
+class ServerConfig():
+    """ Settings of a configured vRO server (defaults already applied)
+    """
+    __slots__ = ('name',) + SERVER_KEYS
+
+    def __init__(self, name, user=None, pwd=None, verify_ssl=True, protocol=DEFAULT_PROTOCOL,
+                 retries=DEFAULT_RETRIES, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.user = user
+        self.pwd = pwd
+        self.verify_ssl = verify_ssl
+        self.protocol = protocol
+        self.retries = retries
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+
+class Config():
+    """ Validated content of the configuration file
+    """
+    __slots__ = ('log_level', 'template_cache', 'state_file', 'inventory_file', 'cache_dir',
+                 'cache_size', 'compression', 'packages', 'vro_servers', 'package_groups')
+
+    def __init__(self, log_level='INFO', template_cache=None, state_file=DEFAULT_STATE_FILE,
+                 inventory_file=DEFAULT_INVENTORY_FILE, cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+                 compression=DEFAULT_COMPRESSION, packages=None, vro_servers=None,
+                 package_groups=None):
+        self.log_level = log_level
+        self.template_cache = template_cache
+        self.state_file = state_file
+        self.inventory_file = inventory_file
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.compression = compression
+        # PackageConfig and ServerConfig objects by name
+        self.packages = packages or {}
+        self.vro_servers = vro_servers or {}
+        # lists of package names by group name
+        self.package_groups = package_groups or {}
+
+
+def read_config(path=CONFIG_FILE):
+    """ Read the configuration file and return the config object
+
+    The compiled configuration is saved in a snapshot next to the file and
+    reused as long as the file is unchanged, so it is parsed and validated
+    once. Snapshots are plain JSON data: loading one does not run any code.
+    """
+    try:
+        with open(path, 'rb') as conffile:
+            content = conffile.read()
+    except OSError as e:
+        logger.error("Cannot read configuration file %s: %s" % (path, e))
+        exit(-1)
+    checksum = hashlib.sha256(content).hexdigest()
+    snapshot_file = path + '.cache'
+    config = _load_snapshot(snapshot_file, checksum)
+    if config is None:
+        config = compile_config(_parse_yaml(content))
+        _save_snapshot(snapshot_file, checksum, config)
+    logger.setLevel(config.log_level)
+    return config
+
+
+def _parse_yaml(content):
+    """ Returns the vrocli section of a YAML configuration content
+    """
+    import yaml
+    # C implementation of the loader, if PyYAML was built with libyaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        data = yaml.load(content, Loader=loader)
+    except yaml.YAMLError as e:
+        logger.error(e)
+        exit(-1)
+    if not isinstance(data, dict) or not isinstance(data.get('vrocli'), dict):
+        logger.error("Invalid configuration: a 'vrocli' section is required")
+        exit(-1)
+    return data['vrocli']
+
+
+def _load_snapshot(snapshot_file, checksum):
+    """ Returns the compiled configuration saved in snapshot_file if it was
+    compiled from a configuration file with this checksum (None otherwise)
+    """
+    try:
+        with open(snapshot_file, 'r') as infile:
+            snapshot = json.load(infile)
+        if snapshot['version'] != SNAPSHOT_VERSION or snapshot['checksum'] != checksum:
+            return None
+        return _config_from_data(snapshot['config'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _save_snapshot(snapshot_file, checksum, config):
+    # the snapshot holds the passwords of the servers: only readable by the
+    # user
+    tmp_file = snapshot_file + '.tmp'
+    try:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump({'version': SNAPSHOT_VERSION, 'checksum': checksum,
+                       'config': _config_to_data(config)}, outfile)
+        os.replace(tmp_file, snapshot_file)
+    except OSError as e:
+        logger.debug("Cannot save configuration snapshot %s: %s" % (snapshot_file, e))
+
+
+def _config_to_data(config):
+    """ Returns the content of a Config object as plain data
+    """
+    data = dict((key, getattr(config, key)) for key in Config.__slots__)
+    data['packages'] = dict(
+        (name, dict((key, getattr(conf, key)) for key in PackageConfig.__slots__))
+        for name, conf in config.packages.items())
+    data['vro_servers'] = dict(
+        (name, dict((key, getattr(conf, key)) for key in ServerConfig.__slots__))
+        for name, conf in config.vro_servers.items())
+    return data
+
+
+def _config_from_data(data):
+    """ Returns the Config object of plain data from _config_to_data
+    """
+    data = dict(data)
+    data['packages'] = dict((name, PackageConfig(**conf))
+                            for name, conf in data['packages'].items())
+    vro_servers = {}
+    for name, conf in data['vro_servers'].items():
+        if isinstance(conf.get('timeout'), list):
+            conf['timeout'] = tuple(conf['timeout'])
+        vro_servers[name] = ServerConfig(**conf)
+    data['vro_servers'] = vro_servers
+    return Config(**data)
+
+
+def compile_config(data):
+    """ Validate the vrocli section of a configuration and returns it as a
+    Config object
+
+    Every error found is reported before exiting.
+    """
+    errors = []
+
+    def _section(name, value):
+        # empty sections (only comments in the file) are None
+        if value is None:
+            return {}
+        if not isinstance(value, dict):
+            errors.append("'%s' must be a mapping" % name)
+            return {}
+        return value
+
+    log_level = data.get('log_level', 'INFO')
+    if not isinstance(log_level, int) and not isinstance(logging.getLevelName(log_level), int):
+        errors.append("Invalid log_level: %s" % log_level)
+    cache_size = data.get('cache_size', DEFAULT_CACHE_SIZE)
+    if not isinstance(cache_size, (int, float)) or cache_size < 0:
+        errors.append("cache_size must be a positive number of MB")
+    compression = data.get('compression') or DEFAULT_COMPRESSION
+    if compression not in COMPRESSION_MODES:
+        errors.append("Invalid compression: %s (%s)" % (compression, ", ".join(COMPRESSION_MODES)))
+
+    default_paths = _section('default_paths', data.get('default_paths'))
+    packages = {}
+    for name, conf in _section('packages', data.get('packages')).items():
+        conf = _section('packages/%s' % name, conf)
+        _check_keys('packages/%s' % name, conf, PACKAGE_KEYS)
+        paths = {}
+        missing = False
+        for key, suffix in (('package', '.package'), ('expand_target', ''),
+                            ('build_target', '.package'), ('working_dir', '')):
+            default_key = 'packages' if key == 'package' else key
+            if conf.get(key):
+                paths[key] = conf[key]
+            elif default_paths.get(default_key):
+                paths[key] = default_paths[default_key] + name + suffix
+            else:
+                missing = True
+                errors.append("No %s for package %s (and no default_paths/%s)"
+                              % (key, name, default_key))
+        if conf.get('compression') and conf['compression'] not in COMPRESSION_MODES:
+            errors.append("Invalid compression for package %s: %s" % (name, conf['compression']))
+        if not missing:
+            packages[name] = PackageConfig(name, compression=conf.get('compression'), **paths)
+
+    vro_servers = {}
+    for name, conf in _section('vro_servers', data.get('vro_servers')).items():
+        conf = _section('vro_servers/%s' % name, conf)
+        _check_keys('vro_servers/%s' % name, conf, SERVER_KEYS)
+        conf = dict((k, v) for k, v in conf.items() if k in SERVER_KEYS and v is not None)
+        if conf.get('protocol', DEFAULT_PROTOCOL) not in ('http', 'https'):
+            errors.append("Invalid protocol for server %s: %s" % (name, conf['protocol']))
+        for key in ('retries', 'pool_size'):
+            if not isinstance(conf.get(key, 0), int) or conf.get(key, 0) < 0:
+                errors.append("%s of server %s must be a positive integer" % (key, name))
+        timeout = conf.get('timeout', DEFAULT_TIMEOUT)
+        if isinstance(timeout, list):
+            timeout = conf['timeout'] = tuple(timeout)
+        if not (isinstance(timeout, (int, float)) or (isinstance(timeout, tuple) and
+                len(timeout) == 2 and all(isinstance(t, (int, float)) for t in timeout))):
+            errors.append("timeout of server %s must be a number or [connect, read]" % name)
+        vro_servers[name] = ServerConfig(name, **conf)
+
+    package_groups = {}
+    for group, names in _section('package_groups', data.get('package_groups')).items():
+        if not isinstance(names, list):
+            errors.append("Package group %s must be a list of packages" % group)
+            continue
+        for name in names:
+            if name not in packages:
+                errors.append("Package %s of group %s is not configured" % (name, group))
+        package_groups[group] = names
+
+    if errors:
+        for error in errors:
+            logger.error("Invalid configuration: %s" % error)
+        exit(-1)
+    return Config(log_level=log_level,
+                  template_cache=data.get('template_cache'),
+                  state_file=data.get('state_file') or DEFAULT_STATE_FILE,
+                  inventory_file=data.get('inventory_file') or DEFAULT_INVENTORY_FILE,
+                  cache_dir=data.get('cache_dir', DEFAULT_CACHE_DIR),
+                  cache_size=cache_size,
+                  compression=compression,
+                  packages=packages,
+                  vro_servers=vro_servers,
+                  package_groups=package_groups)
+
+
+def _check_keys(section, conf, known):
+    for key in conf:
+        if key not in known:
+            logger.warning("Unknown setting %s in %s of the configuration" % (key, section))
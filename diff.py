@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import zipfile
+import difflib
+from utils import logger
+from package import parse_element
+
+# compared fields of the actions, with their label
+ACTION_FIELDS = (
+    ('name', 'name'),
+    ('category', 'module'),
+    ('description', 'description'),
+    ('params', 'params'),
+    ('xml_result', 'result type'),
+    ('script', 'script'),
+)
+
+
+class ElementDiff():
+    """ Difference of an element (or of an entry outside of the elements)
+    between two packages
+
+    status is 'added', 'removed' or 'changed'; fields are the labels of the
+    action fields which changed, or the names of the changed entries for
+    the elements which are not actions.
+    """
+    __slots__ = ('status', 'key', 'old', 'new', 'fields')
+
+    def __init__(self, status, key, old=None, new=None, fields=()):
+        self.status = status
+        self.key = key
+        self.old = old
+        self.new = new
+        self.fields = fields
+
+
+    def action(self):
+        return self.new or self.old
+
+
+    def describe(self):
+        """ Returns a one line description of the difference
+        """
+        flag = {'added': 'A', 'removed': 'D', 'changed': 'M'}[self.status]
+        action = self.action()
+        if action:
+            line = "%s %s/%s (%s)" % (flag, action.category, action.name, action.id)
+        else:
+            line = "%s %s" % (flag, self.key)
+        if self.fields:
+            line += ": " + ", ".join(self.fields)
+        return line
+
+
+    def details(self, old_label='a', new_label='b'):
+        """ Returns the lines describing the changed fields of an action
+        (unified diff of the script)
+        """
+        lines = []
+        if not (self.old and self.new):
+            return lines
+        for attr, label in ACTION_FIELDS:
+            if label not in self.fields:
+                continue
+            if attr == 'script':
+                lines.extend(l.rstrip('\n') for l in difflib.unified_diff(
+                    (self.old.script or '').splitlines(), (self.new.script or '').splitlines(),
+                    "%s/%s" % (old_label, self.old.name), "%s/%s" % (new_label, self.new.name),
+                    lineterm=''))
+            elif attr == 'params':
+                lines.append("- params: %s" % _params_text(self.old.params))
+                lines.append("+ params: %s" % _params_text(self.new.params))
+            else:
+                lines.append("- %s: %s" % (label, getattr(self.old, attr)))
+                lines.append("+ %s: %s" % (label, getattr(self.new, attr)))
+        return lines
+
+
+class PackageDirectory():
+    """ Entries of a package file read from its zip central directory: name,
+    CRC32 and size of each entry, grouped by element id (by entry name for
+    the entries outside of the elements)
+    """
+    def __init__(self, package_file):
+        self.path = package_file
+        # element id -> list of (name, CRC32, size)
+        self.elements = {}
+        try:
+            with zipfile.ZipFile(package_file, 'r') as zipf:
+                infos = zipf.infolist()
+        except zipfile.BadZipFile:
+            logger.error("%s is not a valid package archive" % package_file)
+            exit(-1)
+        for info in infos:
+            parts = info.filename.split('/')
+            key = parts[1] if len(parts) == 3 and parts[0] == 'elements' else info.filename
+            self.elements.setdefault(key, []).append((info.filename, info.CRC, info.file_size))
+        for key in self.elements:
+            self.elements[key].sort()
+
+
+    def actions(self, keys):
+        """ Returns the actions of the elements of keys which are actions, by
+        element id
+        """
+        actions = {}
+        with zipfile.ZipFile(self.path, 'r') as zipf:
+            names = set(zipf.namelist())
+            for key in keys:
+                data = 'elements/%s/data' % key
+                categories = 'elements/%s/categories' % key
+                if data not in names:
+                    continue
+                action = parse_element(key, zipf.read(data), zipf.read(categories)
+                                       if categories in names else None)
+                if action:
+                    actions[key] = action
+        return actions
+
+
+def diff_packages(old_file, new_file):
+    """ Returns the ElementDiff of the elements which differ between two
+    package files, and the number of elements whose entries differ but not
+    their action (like an action built again from the same content)
+
+    The entries are compared with the central directories only: the
+    elements with different entries are the only ones read and parsed.
+    """
+    old_dir = PackageDirectory(old_file)
+    new_dir = PackageDirectory(new_file)
+    old_entries, new_entries = old_dir.elements, new_dir.elements
+    removed = [key for key in old_entries if key not in new_entries]
+    added = [key for key in new_entries if key not in old_entries]
+    different = [key for key in old_entries
+                 if key in new_entries and old_entries[key] != new_entries[key]]
+    old_actions = old_dir.actions(removed + different)
+    new_actions = new_dir.actions(added + different)
+    diffs = [ElementDiff('removed', key, old=old_actions.get(key)) for key in removed]
+    diffs.extend(ElementDiff('added', key, new=new_actions.get(key)) for key in added)
+    unchanged = 0
+    for key in different:
+        old, new = old_actions.get(key), new_actions.get(key)
+        if old and new:
+            fields = tuple(label for attr, label in ACTION_FIELDS
+                           if _field(old, attr) != _field(new, attr))
+            if not fields:
+                unchanged += 1
+                continue
+        else:
+            old_crcs = dict((e[0], e[1:]) for e in old_entries[key])
+            new_crcs = dict((e[0], e[1:]) for e in new_entries[key])
+            fields = tuple(sorted(n.rsplit('/', 1)[-1] for n in set(old_crcs) |
+                                  set(new_crcs) if old_crcs.get(n) != new_crcs.get(n)))
+        diffs.append(ElementDiff('changed', key, old, new, fields))
+    diffs.sort(key=_sort_key)
+    return diffs, unchanged
+
+
+def _sort_key(diff):
+    # actions by module and name, then the other elements and entries
+    action = diff.action()
+    if action:
+        return (0, action.category or '', action.name or '', diff.key)
+    return (1, '', '', diff.key)
+
+
+def _field(action, attr):
+    if attr == 'params':
+        return [p.as_dict() for p in action.params]
+    return getattr(action, attr)
+
+
+def _params_text(params):
+    return ", ".join("%s (%s)" % (p.name, p.type) for p in params) or "-"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import json
+from utils import logger
+
+
+class PackageIndex():
+    """ Index of the actions of a package: module file and checksum of each
+    action, by id, with lookups by name and category
+
+    The index is updated when the package is expanded or built, so finding
+    an action does not need to read the module files.
+    """
+    def __init__(self, path):
+        self.path = path
+        # action id -> {'name', 'category', 'file', 'checksum'}
+        self.actions = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as infile:
+                try:
+                    self.actions = json.load(infile)['actions']
+                except (ValueError, KeyError):
+                    logger.warning("Invalid package index %s, ignoring it" % path)
+        self._by_name = None
+        self._by_category = None
+
+
+    def update(self, files):
+        """ Replace the content of the index by the actions of files, a dict
+        of the actions of each module file
+        """
+        self.actions = {}
+        for file in sorted(files):
+            for action in files[file]:
+                self.actions[action.id] = {
+                    'name': action.name,
+                    'category': action.category,
+                    'file': file,
+                    'checksum': action.checksum()
+                }
+        self._by_name = self._by_category = None
+
+
+    def save(self):
+        index_dir = os.path.dirname(self.path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump({'actions': self.actions}, outfile)
+        os.replace(self.path + '.tmp', self.path)
+
+
+    def _lookups(self):
+        if self._by_name is None:
+            self._by_name = {}
+            self._by_category = {}
+            for action_id, entry in self.actions.items():
+                self._by_name.setdefault(entry['name'], []).append(action_id)
+                self._by_category.setdefault(entry['category'], []).append(action_id)
+
+
+    def find(self, key):
+        """ Returns the (id, entry) of the actions with key as id or name
+        """
+        if key in self.actions:
+            return [(key, self.actions[key])]
+        self._lookups()
+        return [(i, self.actions[i]) for i in self._by_name.get(key, [])]
+
+
+    def category(self, category):
+        """ Returns the (id, entry) of the actions of a category, by name
+        """
+        self._lookups()
+        return sorted(((i, self.actions[i]) for i in self._by_category.get(category, [])),
+                      key=lambda a: a[1]['name'])
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import time
+import json
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from utils import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    server TEXT PRIMARY KEY,
+    last_refresh REAL
+);
+CREATE TABLE IF NOT EXISTS actions (
+    server TEXT,
+    id TEXT,
+    name TEXT,
+    module TEXT,
+    version TEXT,
+    checksum TEXT,
+    last_seen REAL,
+    PRIMARY KEY (server, id)
+);
+CREATE INDEX IF NOT EXISTS actions_name ON actions (name);
+CREATE INDEX IF NOT EXISTS actions_module ON actions (module);
+CREATE TABLE IF NOT EXISTS packages (
+    server TEXT,
+    name TEXT,
+    id TEXT,
+    version TEXT,
+    checksum TEXT,
+    last_seen REAL,
+    PRIMARY KEY (server, name)
+);
+"""
+
+
+class Inventory():
+    """ SQLite index of the actions and packages found on the vRO servers
+
+    Actions are stored with the checksum of their content (the one used by
+    the build manifests), which is only computed again for the actions
+    added or with a new version since the previous refresh.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        self.db.close()
+
+
+    def refresh(self, server, jobs=4, page_size=None):
+        """ Update the actions and packages of a server (a VroServer)
+
+        Returns the number of actions listed, of actions fetched again
+        (new or changed) and of packages listed.
+        """
+        now = time.time()
+        actions = server.catalog('Action', page_size, jobs)
+        known = dict((row['id'], (row['version'], row['checksum'])) for row in self.db.execute(
+            "SELECT id, version, checksum FROM actions WHERE server = ?", (server.hostname,)))
+        changed = [a for a in actions
+                   if a['id'] not in known or known[a['id']][0] != a.get('version')]
+        logger.info("%d action(s) on %s, %d new or changed" %
+                    (len(actions), server.hostname, len(changed)))
+        checksums = dict((i, k[1]) for i, k in known.items())
+        if changed:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for action, content in zip(changed, executor.map(
+                        lambda a: server.get_action(a['id']), changed)):
+                    checksums[action['id']] = action_checksum(content)
+        packages = server.catalog('Package', page_size, jobs)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(server.hostname, a['id'], a.get('name'), a.get('module'), a.get('version'),
+                  checksums[a['id']], now) for a in actions])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+                [(server.hostname, p.get('name'), p.get('id'), p.get('version'),
+                  _attributes_checksum(p), now) for p in packages])
+            # forget the items removed from the server
+            for table in ('actions', 'packages'):
+                self.db.execute("DELETE FROM %s WHERE server = ? AND last_seen < ?" % table,
+                                (server.hostname, now))
+            self.db.execute("INSERT OR REPLACE INTO servers VALUES (?, ?)",
+                            (server.hostname, now))
+        return len(actions), len(changed), len(packages)
+
+
+    def find_action(self, key):
+        """ Returns the actions with key as id, name or module/name, on every
+        server
+        """
+        return self.db.execute(
+            "SELECT * FROM actions WHERE id = ? OR name = ? OR module || '/' || name = ? "
+            "ORDER BY module, name, server", (key, key, key)).fetchall()
+
+
+    def module_actions(self, module, server=None):
+        """ Returns the actions of a module (on a server or on every server)
+        """
+        if server:
+            return self.db.execute("SELECT * FROM actions WHERE module = ? AND server = ? "
+                                   "ORDER BY name", (module, server)).fetchall()
+        return self.db.execute("SELECT * FROM actions WHERE module = ? ORDER BY name, server",
+                               (module,)).fetchall()
+
+
+    def find_package(self, name):
+        """ Returns the package with this name on every server
+        """
+        return self.db.execute("SELECT * FROM packages WHERE name = ? ORDER BY server",
+                               (name,)).fetchall()
+
+
+def action_checksum(content):
+    """ Returns the checksum of an action from its content returned by the
+    vRO API, as computed for the actions of packages
+    """
+    from action import Action, Param
+    action = Action(
+        id=content.get('id'),
+        name=content.get('name'),
+        description=content.get('description') or '',
+        params=[Param(p.get('name'), p.get('type'), p.get('description'))
+                for p in content.get('input-parameters', [])],
+        script=content.get('script'),
+        category=content.get('module'),
+        xml_result=content.get('output-type')
+    )
+    return action.checksum()
+
+
+def _attributes_checksum(attributes):
+    return hashlib.sha1(json.dumps(attributes, sort_keys=True).encode('utf-8')).hexdigest()
@@ -5,120 +5,499 @@ import os
 from lxml import etree
 import zipfile
 import re
-from utils import logger
-from action import Action
+import json
+import copy
+import struct
+import zlib
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils import logger, module_mtimes, flush_logging, Progress
+from state import package_fingerprint
+from index import PackageIndex
+import profiling
+from action import Action, Param, js_render_many, get_template, template_xml_file
+
+# size of the chunks used to copy raw zip entries
+COPY_CHUNK_SIZE = 1024 * 1024
+# zip compression method and level of each compression mode
+COMPRESSION = {
+    'store': (zipfile.ZIP_STORED, None),
+    'fast': (zipfile.ZIP_DEFLATED, 1),
+    'default': (zipfile.ZIP_DEFLATED, 6),
+    'max': (zipfile.ZIP_DEFLATED, 9),
+}
+# threads compressing the rendered entries (zlib runs without the GIL)
+COMPRESS_WORKERS = os.cpu_count() or 1
+# number of actions sent at once to the worker processes rendering them
+RENDER_BATCH_SIZE = 32
 
 
 class Package():
     def __init__(self, name, config):
         self.name = name
         package_conf = self.is_configured(config)
-        self.src_package = package_conf.get('package',
-            config['default_paths']['packages'] + name + '.package')
-        self.expand_target = package_conf.get('expand_target',
-            config['default_paths']['expand_target'] + name)
-        self.wd = package_conf.get('working_dir',
-            config['default_paths']['working_dir'] + name)
-        self.build = package_conf.get('build_target',
-            config['default_paths']['build_target'] + name + '.package')
+        self.src_package = package_conf.package
+        self.expand_target = package_conf.expand_target
+        self.wd = package_conf.working_dir
+        self.build = package_conf.build_target
+        self.compression = package_conf.compression or config.compression
+        self.manifest_file = self.build + '.manifest'
+        # the package is not unzipped: expand_target is the path prefix of
+        # its metadata files
+        self.expanded_file = self.expand_target + '.expanded.json'
+        self.index_file = self.expand_target + '.index.json'
 
 
     def is_configured(self , config):
         try:
-            return config['packages'][self.name]
+            return config.packages[self.name]
         except KeyError:
             logger.error("Package %s is not configured. Ensure to add it to your local configuration before to use it." 
                 % self.name)
             exit(-1)
 
 
-    def expand(self):
-        """ Expand actions from source path to target one
+    def expand(self, jobs=1):
+        """ Expand actions from the package file to the working directory
+
+        Elements are read straight from the package archive and parsed by a
+        pool of jobs worker processes, then each module file is written at
+        once with its actions sorted by name.
         """
-        categories = []
+        if not os.path.isfile(self.src_package):
+            logger.error("Package not found %s" % self.src_package)
+            exit(-1)
         if not os.path.exists(self.wd):
             os.makedirs(self.wd)
 
-        elements_path = os.path.join(self.expand_target, 'elements')
-        for root, dirs, files in os.walk(elements_path):  # pylint: disable=unused-variable
-            for elem in dirs:
-                logger.info('Unboxing item with id %s' % elem)
-                act_id = elem
-                act_data = os.path.join(elements_path, elem, 'data')
-                try:
-                    act_tree = etree.parse(act_data)
-                except etree.XMLSyntaxError:
-                    act_tree = None
-                try:
-                    act_name = act_tree.xpath("/dunes-script-module")[0].get('name')
-                except IndexError:
-                    act_name = None
-                except AttributeError:
-                    act_name = None
-                if act_tree and act_name:
-                    act_return = act_tree.xpath("/dunes-script-module")[0].get('result-type')
-                    try:
-                        act_desc = act_tree.xpath(
-                            "/dunes-script-module/description")[0].text
-                    except IndexError:
-                        act_desc = ""
-                    act_script = act_tree.xpath("/ dunes-script-module/script")[0].text
-                    act_params = []
-                    for par in act_tree.xpath("/ dunes-script-module/param"):
-                        act_params.append({
-                            'name': par.get('n'),
-                            'type': par.get('t'),
-                            'desc': par.text
-                        })
-
-                    act_cat_tree = etree.parse(os.path.join(
-                        elements_path, elem, 'categories'))
-                    act_cat = act_cat_tree.xpath("/categories/category/name")[0].text
-                    action = Action(
-                        id=act_id,
-                        name=act_name,
-                        description=act_desc,
-                        params=act_params,
-                        script=act_script,
-                        category=act_cat,
-                        xml_result=act_return
-                    )
-                    mod_file = os.path.join(self.wd, act_cat + '.js')
-                    if not act_cat in categories:
-                        logger.debug("New module found: %s" % act_cat)
-                        # new module file
-                        categories.append(act_cat)
-                        with open(mod_file, 'w') as outfile:
-                            outfile.write("/** @module " + act_cat + " */\n\n")
-                    logger.debug('Rendering action to module file')
-                    action.js_render(mod_file)
-                else:
-                    logger.info("Item with ID %s was ignored as it is not a vRO action" 
-                        % act_id)
+        logger.info("Reading package content")
+        with profiling.stage('read package') as counts:
+            with zipfile.ZipFile(self.src_package, 'r') as zipf:
+                elements = sorted(_element_id(name) for name in zipf.namelist()
+                                  if _element_id(name))
+            counts['files'] = len(elements)
+            counts['bytes'] = os.path.getsize(self.src_package)
+        progress = Progress("item(s) unboxed", len(elements))
+        with profiling.stage('parse elements') as counts:
+            if jobs > 1 and len(elements) > 1:
+                size = max(1, len(elements) // (jobs * 4))
+                chunks = [elements[i:i + size] for i in range(0, len(elements), size)]
+                # write the pending records before forking the workers
+                flush_logging()
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    actions = []
+                    for chunk_actions in executor.map(parse_elements,
+                                                      [self.src_package] * len(chunks), chunks):
+                        actions.extend(chunk_actions)
+                        progress.update(len(chunk_actions))
+            else:
+                actions = parse_elements(self.src_package, elements, progress)
+            counts['actions'] = len([a for a in actions if a])
+        progress.done()
+
+        modules = {}
+        ignored = 0
+        for elem, action in zip(elements, actions):
+            if action:
+                modules.setdefault(action.category, []).append(action)
+            else:
+                ignored += 1
+                logger.debug("Item with ID %s was ignored as it is not a vRO action", elem)
+        if ignored:
+            logger.info("%d item(s) ignored as they are not vRO actions" % ignored)
+        files = {}
+        with profiling.stage('expand', files=0, bytes=0) as counts:
+            for category in sorted(modules):
+                logger.debug("New module found: %s", category)
+                mod_file = os.path.join(self.wd, category + '.js')
+                actions = sorted(modules[category], key=lambda a: (a.name, a.id))
+                content = "/** @module " + category + " */\n\n" + js_render_many(actions)
+                with open(mod_file, 'w') as outfile:
+                    outfile.write(content)
+                files[mod_file] = actions
+                counts['files'] += 1
+                counts['bytes'] += len(content)
+        self.write_index(files)
+        with open(self.expanded_file, 'w') as outfile:
+            json.dump({'fingerprint': package_fingerprint(self.src_package)[0],
+                       'files': module_mtimes(self.wd)}, outfile)
         logger.info("Actions expanded in: %s" % self.wd)
 
 
-    def unzip(self):
-        """ Unzip a package file to the expand target
+    def is_expanded(self):
+        """ Returns True if the working directory holds the expansion of the
+        current package file, without any module file changed since
+        """
+        if not (os.path.isfile(self.expanded_file) and os.path.isfile(self.src_package)):
+            return False
+        with open(self.expanded_file, 'r') as infile:
+            try:
+                expanded = json.load(infile)
+            except ValueError:
+                return False
+        return (expanded['files'] == module_mtimes(self.wd) and
+                expanded['fingerprint'] == package_fingerprint(self.src_package)[0])
+
+
+    def read_index(self):
+        """ Returns the index of the actions of the package
+        """
+        return PackageIndex(self.index_file)
+
+
+    def write_index(self, files):
+        """ Save the index of the actions of each module file (a dict of the
+        actions of each file)
+        """
+        index = self.read_index()
+        index.update(files)
+        index.save()
+
+
+    def read_manifest(self):
+        """ Returns the manifest of the previous build (or an empty one)
+
+        The manifest stores the checksum of the actions put in the last
+        built package.
+        """
+        manifest = {'actions': {}}
+        if os.path.isfile(self.manifest_file) and os.path.isfile(self.build):
+            with open(self.manifest_file, 'r') as infile:
+                try:
+                    manifest.update(json.load(infile))
+                except ValueError:
+                    logger.warning("Invalid build manifest %s, ignoring it" % self.manifest_file)
+        return manifest
+
+
+    def write_manifest(self, manifest):
+        """ Save the manifest of the last build
+        """
+        with open(self.manifest_file, 'w') as outfile:
+            json.dump(manifest, outfile)
+
+
+    def rebuild(self, actions, manifest=None, shared=None, jobs=1):
+        """ Build a new .package file from the package file and actions
+
+        Entries of the package file are copied as-is (without being
+        decompressed) to the new package, except the data of the given
+        actions which is rendered again. If the manifest of the previous
+        build is provided, actions unchanged since that build are copied
+        from the previous package instead of being rendered and compressed.
+        shared (a SharedElements) holds the elements of the packages
+        already built in the same run: identical actions are copied from
+        them too.
+        Rendered entries are compressed (according to self.compression) by
+        a pool of threads while the next ones are rendered, or, with jobs
+        greater than 1, rendered and compressed by a pool of jobs worker
+        processes. They are written in the order of the package file with
+        the timestamps of its entries, so the same inputs always give the
+        same package file.
         """
         if not os.path.isfile(self.src_package):
-            print("Package not found %s" % self.src_package)
+            logger.error("Package not found %s" % self.src_package)
             exit(-1)
-        if not os.path.exists(self.expand_target):
-            os.makedirs(self.expand_target)
-        logger.info("Extracting package content")
-        zip_ref = zipfile.ZipFile(self.src_package, 'r')
-        zip_ref.extractall(self.expand_target)
-        zip_ref.close()
+        logger.info("Building new package at %s" % self.build)
+        build_dir = os.path.dirname(self.build)
+        if build_dir and not os.path.exists(build_dir):
+            os.makedirs(build_dir)
+        if manifest is None:
+            manifest = {'actions': {}}
+        by_id = dict((a.id, a) for a in actions)
+        previous = None
+        if manifest['actions'] and os.path.isfile(self.build) and \
+                manifest.get('compression') == self.compression:
+            previous = zipfile.ZipFile(self.build, 'r')
+        checksums = {}
+        reused = 0
+        deduplicated = 0
+        template = get_template(template_xml_file)
+        tmp_build = self.build + '.tmp'
+        # entries waiting to be written: ('copy', arguments of
+        # _copy_zip_entry) or ('write', future of the compressed entry)
+        pending = collections.deque()
+
+        # entries waiting to be sent to the worker processes: (action, info,
+        # pending item) where the item gets the (future, index) of the entry
+        batch = []
+        if jobs > 1:
+            # write the pending records before forking the workers
+            flush_logging()
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            limit = jobs * RENDER_BATCH_SIZE * 4
+        else:
+            executor = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS)
+            limit = COMPRESS_WORKERS * 4
 
+        def _submit():
+            if batch:
+                future = executor.submit(_render_zip_entries, [b[:2] for b in batch],
+                                         self.compression)
+                for index, b in enumerate(batch):
+                    b[2][1] = (future, index)
+                del batch[:]
+
+        def _ready(item):
+            if item[0] == 'copy':
+                return True
+            if item[0] == 'render':
+                return item[1] is not None and item[1][0].done()
+            return item[1].done()
+
+        def _flush(limit):
+            while pending and (len(pending) > limit or _ready(pending[0])):
+                if pending[0][0] == 'render' and pending[0][1] is None:
+                    _submit()
+                kind, entry = pending.popleft()
+                if kind == 'copy':
+                    _copy_zip_entry(*entry)
+                elif kind == 'render':
+                    _write_zip_entry(zipf, *entry[0].result()[entry[1]])
+                else:
+                    _write_zip_entry(zipf, *entry.result())
 
-    def rebuild(self):
-        """ Rebuild a .package file from local expanded files
+        with profiling.stage('rebuild') as counts:
+            try:
+                with zipfile.ZipFile(self.src_package, 'r') as source, \
+                        zipfile.ZipFile(tmp_build, "w", zipfile.ZIP_DEFLATED) as zipf, \
+                        executor:
+                    counts['files'] = len(source.infolist())
+                    progress = Progress("item(s) processed", counts['files'])
+                    for info in source.infolist():
+                        _flush(limit)
+                        progress.update()
+                        action = by_id.pop(_element_id(info.filename), None)
+                        if not action:
+                            pending.append(('copy', (source, zipf, info)))
+                            continue
+                        checksum = action.checksum()
+                        checksums[action.id] = checksum
+                        if previous and manifest['actions'].get(action.id) == checksum:
+                            try:
+                                pending.append(('copy', (previous, zipf,
+                                                         previous.getinfo(info.filename),
+                                                         info.date_time)))
+                                reused += 1
+                                continue
+                            except KeyError:
+                                pass
+                        entry = shared.lookup(checksum, self.compression) if shared else None
+                        if entry:
+                            pending.append(('copy', (entry[0], zipf, entry[1], info.date_time)))
+                            deduplicated += 1
+                            continue
+                        if jobs > 1:
+                            item = ['render', None]
+                            pending.append(item)
+                            batch.append((action, info, item))
+                            if len(batch) >= RENDER_BATCH_SIZE:
+                                _submit()
+                            continue
+                        with profiling.stage('xml_render', actions=1):
+                            data = action.xml_data(template)
+                        pending.append(('write', executor.submit(
+                            _compress_zip_entry, info, data, self.compression)))
+                    _submit()
+                    _flush(0)
+            finally:
+                if previous:
+                    previous.close()
+            for action in by_id.values():
+                logger.warning("Action %s (%s) is not in package %s, it was ignored" %
+                               (action.name, action.id, self.src_package))
+            if shared:
+                shared.forget(self.build)
+            os.replace(tmp_build, self.build)
+            counts['bytes'] = os.path.getsize(self.build)
+        if shared:
+            for action_id, checksum in checksums.items():
+                shared.add(checksum, self.compression, self.build,
+                           'elements/%s/data' % action_id)
+            logger.info("%d action(s) rendered, %d reused from previous build, "
+                        "%d from other packages" % (len(checksums) - reused - deduplicated,
+                                                    reused, deduplicated))
+        else:
+            logger.info("%d action(s) rendered, %d reused from previous build" %
+                        (len(checksums) - reused, reused))
+        manifest['actions'] = checksums
+        manifest['compression'] = self.compression
+        self.write_manifest(manifest)
+
+
+class SharedElements():
+    """ Element entries of the packages built in a same run, by checksum of
+    their action (and compression), so identical actions are rendered and
+    compressed once
+    """
+    def __init__(self):
+        # (checksum, compression) -> (package file, entry name)
+        self.entries = {}
+        # opened package files
+        self.files = {}
+
+
+    def add(self, checksum, compression, package_file, name):
+        self.entries.setdefault((checksum, compression), (package_file, name))
+
+
+    def lookup(self, checksum, compression):
+        """ Returns the opened package file and the info of the entry of an
+        action (None if no built package holds this action)
         """
-        logger.info("Building new package at %s" % self.build)
-        with zipfile.ZipFile(self.build, "w", zipfile.ZIP_DEFLATED) as zipf:
-            len_dir_path = len(self.expand_target)
-            for root, _, files in os.walk(self.expand_target):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, file_path[len_dir_path:])
+        if (checksum, compression) not in self.entries:
+            return None
+        package_file, name = self.entries[(checksum, compression)]
+        if package_file not in self.files:
+            self.files[package_file] = zipfile.ZipFile(package_file, 'r')
+        return self.files[package_file], self.files[package_file].getinfo(name)
+
+
+    def forget(self, package_file):
+        """ Drop the entries of a package file which is going to be replaced
+        """
+        if package_file in self.files:
+            self.files.pop(package_file).close()
+        for checksum in [c for c, e in self.entries.items() if e[0] == package_file]:
+            del self.entries[checksum]
+
+
+    def close(self):
+        for zipf in self.files.values():
+            zipf.close()
+        self.files = {}
+
+
+def _element_id(name):
+    """ Returns the element id if name is the data entry of an element
+    """
+    parts = name.split('/')
+    if len(parts) == 3 and parts[0] == 'elements' and parts[2] == 'data':
+        return parts[1]
+    return None
+
+
+def parse_elements(package_file, elements, progress=None):
+    """ Returns the Action stored in each element of a package file (None
+    for elements that are not vRO actions)
+    """
+    actions = []
+    with zipfile.ZipFile(package_file, 'r') as zipf:
+        for elem in elements:
+            if progress:
+                progress.update()
+            with zipf.open('elements/%s/data' % elem) as datafile:
+                # skip other elements (like resources) without reading them
+                data = datafile.read(1024)
+                if not (b'dunes-script-module' in data or
+                        'dunes-script-module'.encode('utf-16-be') in data):
+                    actions.append(None)
+                    continue
+                data += datafile.read()
+            try:
+                categories = zipf.read('elements/%s/categories' % elem)
+            except KeyError:
+                categories = None
+            actions.append(parse_element(elem, data, categories))
+    return actions
+
+
+def parse_element(elem, data, categories):
+    """ Returns the Action stored in the data and categories content of an
+    element (None if the element is not a vRO action)
+    """
+    try:
+        root = etree.fromstring(data)
+    except etree.XMLSyntaxError:
+        return None
+    if root.tag != 'dunes-script-module' or not root.get('name'):
+        return None
+    act_desc = root.findtext('description') or ""
+    act_script = root.findtext('script')
+    act_params = []
+    for par in root.iterfind('param'):
+        act_params.append(Param(par.get('n'), par.get('t'), par.text))
+    act_cat_tree = etree.fromstring(categories)
+    act_cat = act_cat_tree.xpath("/categories/category/name")[0].text
+    return Action(
+        id=elem,
+        name=root.get('name'),
+        description=act_desc,
+        params=act_params,
+        script=act_script,
+        category=act_cat,
+        xml_result=root.get('result-type')
+    )
+
+
+def _copy_zip_entry(source, target, info, date_time=None):
+    """ Copy an already compressed entry from a zip file to another one
+
+    date_time replaces the timestamp of the entry if set.
+    """
+    # find raw compressed data after the local file header
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+    # write it with a new local file header
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08  # sizes and CRC are known: no data descriptor
+    if date_time:
+        zinfo.date_time = date_time
+    zinfo.header_offset = target.fp.tell()
+    target.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.fp.read(min(remaining, COPY_CHUNK_SIZE))
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+    _add_zip_entry(target, zinfo)
+
+
+def _compress_zip_entry(info, data, compression):
+    """ Returns the ZipInfo and compressed content of data, to replace the
+    entry info of a package
+
+    The entry keeps the name, timestamp and attributes of info.
+    """
+    compress_type, level = COMPRESSION[compression]
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.create_system = info.create_system
+    zinfo.external_attr = info.external_attr
+    zinfo.compress_type = compress_type
+    zinfo.file_size = len(data)
+    with profiling.stage('compress', bytes=len(data)):
+        zinfo.CRC = zlib.crc32(data)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def _render_zip_entries(entries, compression):
+    """ Returns the ZipInfo and compressed content of the rendered data of
+    each (action, info) of entries (run by the worker processes of rebuild)
+    """
+    template = get_template(template_xml_file)
+    return [_compress_zip_entry(info, action.xml_data(template), compression)
+            for action, info in entries]
+
+
+def _write_zip_entry(target, zinfo, data):
+    """ Write an already compressed entry to a zip file
+    """
+    zinfo.header_offset = target.fp.tell()
+    target.fp.write(zinfo.FileHeader())
+    target.fp.write(data)
+    _add_zip_entry(target, zinfo)
+
+
+def _add_zip_entry(target, zinfo):
+    """ Register an entry written to the zip file in its central directory
+    """
+    target.filelist.append(zinfo)
+    target.NameToInfo[zinfo.filename] = zinfo
+    target.start_dir = target.fp.tell()
+    target._didModify = True
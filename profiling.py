@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import click
+
+# stages timed since the start of the program: (name, start, end, counts, thread)
+_events = []
+_enabled = False
+
+
+def enable():
+    """ Start recording the stages
+    """
+    global _enabled
+    _enabled = True
+
+
+def record(name, start, end, **counts):
+    """ Record a stage which ran between start and end (time.time() values)
+    """
+    _events.append((name, start, end, counts, threading.get_ident()))
+
+
+@contextmanager
+def stage(name, **counts):
+    """ Time the enclosed block as a stage (if profiling is enabled)
+
+    Yields a dict of counts (actions, bytes, files...) which can be updated
+    in the block and is saved with the stage.
+    """
+    if not _enabled:
+        yield counts
+        return
+    start = time.time()
+    try:
+        yield counts
+    finally:
+        record(name, start, time.time(), **counts)
+
+
+def summary():
+    """ Print a table of the time spent and counts per stage
+    """
+    stages = {}
+    order = []
+    for name, start, end, counts, _ in _events:
+        if name not in stages:
+            order.append(name)
+            stages[name] = {'calls': 0, 'seconds': 0, 'counts': {}}
+        stages[name]['calls'] += 1
+        stages[name]['seconds'] += end - start
+        for key, value in counts.items():
+            stages[name]['counts'][key] = stages[name]['counts'].get(key, 0) + value
+    click.echo("%-20s %8s %10s  %s" % ('Stage', 'Calls', 'Time (s)', 'Counts'), err=True)
+    for name in order:
+        s = stages[name]
+        counts = ", ".join("%s=%s" % c for c in sorted(s['counts'].items()))
+        click.echo("%-20s %8d %10.3f  %s" % (name, s['calls'], s['seconds'], counts), err=True)
+
+
+def save_trace(path):
+    """ Save the recorded stages as a Chrome trace (chrome://tracing, Perfetto)
+    """
+    pid = os.getpid()
+    trace = {'traceEvents': [{
+        'name': name,
+        'cat': 'vrocli',
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': int((end - start) * 1e6),
+        'pid': pid,
+        'tid': tid,
+        'args': counts
+    } for name, start, end, counts, tid in _events]}
+    with open(path, 'w') as outfile:
+        json.dump(trace, outfile)
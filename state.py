@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+from utils import logger
+
+# states shared by all the VroServer objects, by file
+_states = {}
+_states_lock = threading.Lock()
+
+
+def package_fingerprint(package_file):
+    """ Returns the fingerprint of a package file and the CRC32 of its entries
+
+    The fingerprint only depends on the names, sizes and CRC32 of the
+    entries (read from the zip central directory), not on their timestamps
+    or compression, so two builds of the same content match.
+    """
+    entries = {}
+    with zipfile.ZipFile(package_file, 'r') as zipf:
+        for info in zipf.infolist():
+            entries[info.filename] = [info.CRC, info.file_size]
+    sha = hashlib.sha256()
+    for name in sorted(entries):
+        sha.update(("%s:%d:%d\n" % (name, entries[name][0], entries[name][1])).encode('utf-8'))
+    return sha.hexdigest(), entries
+
+
+def get_state(config):
+    """ Returns the deployment state configured in config
+    """
+    path = config.state_file
+    with _states_lock:
+        if path not in _states:
+            _states[path] = DeploymentState(path)
+        return _states[path]
+
+
+class DeploymentState():
+    """ Content of the packages last pushed to/pulled from each server
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.servers = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as infile:
+                try:
+                    self.servers = json.load(infile)
+                except ValueError:
+                    logger.warning("Invalid deployment state %s, ignoring it" % path)
+
+
+    def get(self, server, package):
+        """ Returns the state of a package on a server (None if unknown)
+        """
+        with self.lock:
+            return self.servers.get(server, {}).get(package)
+
+
+    def set(self, server, package, fingerprint, entries, remote=None):
+        """ Save the content of a package pushed to/pulled from a server, and
+        the checksum of its description on the server (remote)
+        """
+        with self.lock:
+            self.servers.setdefault(server, {})[package] = {
+                'fingerprint': fingerprint,
+                'entries': entries,
+                'remote': remote,
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S')
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as outfile:
+                json.dump(self.servers, outfile)
+            os.replace(tmp_path, self.path)
+
+
+def changed_entries(previous, entries):
+    """ Returns the names of the entries added, removed or modified
+    """
+    names = set(previous) | set(entries)
+    return sorted(n for n in names if previous.get(n) != entries.get(n))
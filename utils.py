@@ -1,90 +1,234 @@
 #!/usr/bin/env python
 
 import logging
-import yaml
 import re
 import os
-import coloredlogs
+import time
+import queue
+import atexit
+import threading
 import click
 
-# create logger
+# create logger: records are queued and written by a background thread,
+# whose handlers are only set up when the first record is emitted, so
+# commands which do not log do not pay for them
 logger = logging.getLogger()
-# colored console output
-ch = logging.StreamHandler()
-formatter = coloredlogs.ColoredFormatter("%(asctime)s > %(levelname)s\t> %(message)s",
-                                        "%Y-%m-%d %H:%M:%S")
-ch.setFormatter(formatter)
-#ch.setLevel(logging.INFO)
-logger.addHandler(ch)
-# file output
-fh = logging.FileHandler(filename="./vrocli.log")
-formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s",
-                            "%Y-%m-%d %H:%M:%S")
-fh.setFormatter(formatter)
-fh.setLevel(logging.INFO)
-logger.addHandler(fh)
 logging.captureWarnings(True)
+# the formats do not use the caller, thread or process of the records: do
+# not look them up for each record
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+# maximum number of records written between two flushes of the outputs
+LOG_BATCH_SIZE = 500
+# seconds between two progress summaries of long loops
+PROGRESS_INTERVAL = 2
+# console and file handlers, once set up
+_handlers = []
+# background writer of the records, once started, and the process it runs
+# in (forked worker processes write their records at once)
+_writer = None
+_writer_pid = os.getpid()
 
 
-def read_config():
-    """ Read the configuration file and return the config object
+def setup_logging():
+    """ Set up the colored console output and the ./vrocli.log file output
     """
-    with open('.vrocli.yml', 'r') as conffile:
-        try:
-            config = yaml.load(conffile)['vrocli']
-            logger = logging.getLogger()
-            logger.setLevel(config['log_level'])
-            return config
-        except yaml.YAMLError as e:
-            logger.error(e)
-            exit(-1)
+    if _handlers:
+        return _handlers
+    import coloredlogs
+    # colored console output
+    ch = logging.StreamHandler()
+    formatter = coloredlogs.ColoredFormatter("%(asctime)s > %(levelname)s\t> %(message)s",
+                                            "%Y-%m-%d %H:%M:%S")
+    ch.setFormatter(_cache_time(formatter))
+    # file output
+    fh = logging.FileHandler(filename="./vrocli.log")
+    formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s",
+                                "%Y-%m-%d %H:%M:%S")
+    fh.setFormatter(_cache_time(formatter))
+    fh.setLevel(logging.INFO)
+    _handlers.extend([ch, fh])
+    return _handlers
+
+
+def _cache_time(formatter):
+    """ Make formatter format the time of the records once per second
+    """
+    format_time = formatter.formatTime
+    cache = {}
+
+    def formatTime(record, datefmt=None):
+        second = int(record.created)
+        if second not in cache:
+            cache.clear()
+            cache[second] = format_time(record, datefmt)
+        return cache[second]
+    formatter.formatTime = formatTime
+    return formatter
+
+
+class _LogWriter(threading.Thread):
+    """ Write the queued records to the console and file outputs by batches:
+    the outputs are flushed once per batch instead of once per record
+
+    Besides records, the queue holds the events to set once the previous
+    records are written, and None to stop the writer.
+    """
+    def __init__(self):
+        super().__init__(name='vrocli-log-writer', daemon=True)
+        self.queue = queue.SimpleQueue()
+
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get())
+            written = []
+            for record in batch:
+                if record is None:
+                    stop = True
+                elif isinstance(record, threading.Event):
+                    written.append(record)
+                else:
+                    for handler in _handlers:
+                        if record.levelno >= handler.level:
+                            try:
+                                handler.stream.write(handler.format(record) + handler.terminator)
+                            except Exception:
+                                handler.handleError(record)
+            for handler in _handlers:
+                handler.flush()
+            for event in written:
+                event.set()
+
+
+class _QueueHandler(logging.Handler):
+    """ Queue the records for the background writer, started on the first
+    record
+    """
+    def emit(self, record):
+        global _writer
+        if os.getpid() != _writer_pid or (_writer is not None and not _writer.is_alive()):
+            # forked worker process, or writer already stopped: write the
+            # record at once
+            for handler in setup_logging():
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        if _writer is None:
+            # set up the outputs here: errors are raised to the caller
+            setup_logging()
+            _writer = _LogWriter()
+            _writer.start()
+            atexit.register(stop_logging)
+        # merge the arguments now: they could change before the record is
+        # written
+        record.msg = record.getMessage()
+        record.args = None
+        _writer.queue.put(record)
+
+
+logger.addHandler(_QueueHandler())
+
+
+def flush_logging():
+    """ Wait for the queued records to be written (before prompting the user
+    for instance)
+    """
+    if os.getpid() == _writer_pid and _writer is not None and _writer.is_alive():
+        written = threading.Event()
+        _writer.queue.put(written)
+        written.wait()
+
+
+def stop_logging():
+    """ Write the queued records and stop the background writer
+    """
+    if os.getpid() == _writer_pid and _writer is not None and _writer.is_alive():
+        _writer.queue.put(None)
+        _writer.join()
+
+
+class Progress():
+    """ Log the progress and rate of a long loop every PROGRESS_INTERVAL
+    seconds, instead of a line per item
+    """
+    def __init__(self, what, total=None):
+        self.what = what
+        self.total = total
+        self.count = 0
+        self.start = time.time()
+        self.next = self.start + PROGRESS_INTERVAL
+
+
+    def update(self, count=1):
+        self.count += count
+        now = time.time()
+        if now >= self.next:
+            self.next = now + PROGRESS_INTERVAL
+            if self.total:
+                logger.info("%d/%d %s (%d%%, %d/s)" % (self.count, self.total, self.what,
+                    100 * self.count // self.total, self.count / (now - self.start)))
+            else:
+                logger.info("%d %s (%d/s)" % (self.count, self.what,
+                                              self.count / (now - self.start)))
+
+
+    def done(self):
+        elapsed = time.time() - self.start
+        logger.info("%d %s in %.2fs (%d/s)" % (self.count, self.what, elapsed,
+                                              self.count / elapsed if elapsed else 0))
 
 
 def confirm_action(message):
     """ Prompt user for a confirmation to proceed action
     """
+    flush_logging()
     if not click.confirm(message + " Continue?"):
         logger.info("User cancels action. Exiting...")
         exit(0)
     else: return
 
 
-def get_id_from_comments(raw_action):
-    """ Extract the id of an action from the raw js action
-    """
-    act_id_re = re.compile(r"/\*[ ]*id:(?P<id>[\w-]+)")
-    act_id_m = act_id_re.search(raw_action)
-    if act_id_m:
-        return act_id_m.group(1)
-    else:
-        logger.error("Cannot find id in the following data: %s" % raw_action)
-        exit(-1)
+# vRO actions delimiters in module files
+action_start_re = re.compile(r"/\*[ ]*VRO[ ]+ACTION[ ]+START[ ]*\*/")
+action_end_re = re.compile(r"/\*[ ]*VRO[ ]+ACTION[ ]+END[ ]*\*/")
+# parts of a vRO action
+act_id_re = re.compile(r"/\*[ ]*id:(?P<id>[\w-]+)")
+function_re = re.compile(r"function[ ]+(?P<function>[\w-]+)[ ]*\(\)")
+# jsdoc comment section
+desc_re = re.compile(r"\*[ ]+(?!@)(.*)")
+params_re = re.compile(
+    r"[ ]+\*[ ]+@param[ ]+\{(?P<type>.*)}[ ]+(?P<var_name>\w+)[ ]*(?P<desc>.*)")
+returns_re = re.compile(r"[ ]+\*[ ]+@return[ ]+\{(.*)\}.*")
+# header of module files
+module_re = re.compile(r"/\*\* @module +([\w.]+) +\*/")
 
 
 def get_description_from_comments(act_comments):
     """ Extract description from the jsdoc comment section
     """
-    desc_re = re.compile(r"\*[ ]+(?!@)(.*)")
     return "\n".join(desc_re.findall(act_comments))
 
 
 def get_params_from_comments(act_comments):
     """ Returns list of params found in a jsdoc comment section
     """
-    params_re = re.compile(
-        r"[ ]+\*[ ]+@param[ ]+\{(?P<type>.*)}[ ]+(?P<var_name>\w+)[ ]*(?P<desc>.*)")
+    from action import Param
     act_params = []
     for param_g in params_re.findall(act_comments):
         p_type, p_name, p_desc = param_g
-        param = {'type': p_type, 'name': p_name, 'desc': p_desc}
-        act_params.append(param)
+        act_params.append(Param(p_name, p_type, p_desc))
     return act_params
 
 
 def get_return_from_comment(act_comments):
     """ Returns the result of action found in a jsdoc comment section
     """
-    returns_re = re.compile(r"[ ]+\*[ ]+@return[ ]+\{(.*)\}.*")
     returns_m = returns_re.search(act_comments)
     if returns_m:
         return returns_m.group(1)
@@ -92,64 +236,185 @@ def get_return_from_comment(act_comments):
         return None
 
 
-from action import Action
-def extract_actions_from_module_file(module_name, module_content, target):
+def parse_raw_action(raw_action):
+    """ Returns the id, function name, jsdoc comments and code of a raw
+    action (None for the parts that cannot be found)
+
+    The raw action is scanned once, from one part to the next one.
+    """
+    act_id_m = act_id_re.search(raw_action)
+    act_id = act_id_m.group('id') if act_id_m else None
+    comments_start = raw_action.find('/**')
+    if comments_start < 0:
+        return act_id, None, None, None
+    comments_end = raw_action.find('*/', comments_start + 3)
+    if comments_end < 0:
+        return act_id, None, None, None
+    comments = raw_action[comments_start + 3:comments_end]
+    function_m = function_re.search(raw_action, comments_end + 2)
+    if not function_m:
+        return act_id, None, comments, None
+    code_start = raw_action.find('{', function_m.end())
+    # code ends on the first line starting with a closing bracket
+    code_end = raw_action.find('\n}', code_start)
+    if code_start < 0 or code_end < 0:
+        return act_id, function_m.group('function'), comments, None
+    return (act_id, function_m.group('function'), comments,
+            raw_action[code_start + 1:code_end + 1])
+
+
+def parse_module(module_content, first_line=1):
+    """ Returns the raw actions found in a module content
+
+    Each raw action is a dict with the line where the action starts, its
+    id, function name, jsdoc comments and code (None if not found).
+    """
+    raw_actions = []
+    pos = 0
+    line = first_line
+    while True:
+        start_m = action_start_re.search(module_content, pos)
+        if not start_m:
+            break
+        line += module_content.count('\n', pos, start_m.start())
+        end_m = action_end_re.search(module_content, start_m.end())
+        if not end_m:
+            logger.error("Missing end of vRO action started at line %d" % line)
+            break
+        raw_action = module_content[start_m.end():end_m.start()]
+        act_id, act_name, act_comments, act_script = parse_raw_action(raw_action)
+        raw_actions.append({
+            'line': line,
+            'raw': raw_action,
+            'id': act_id,
+            'name': act_name,
+            'comments': act_comments,
+            'script': act_script
+        })
+        line += module_content.count('\n', start_m.start(), end_m.end())
+        pos = end_m.end()
+    return raw_actions
+
+
+def extract_actions_from_module_file(module_name, module_content, first_line=1):
     """ Returns actions object for a specific src module
+
+    first_line is the line number of the beginning of module_content in the
+    module file (used in error messages).
     """
-    # split module content to actions
-    action_re = re.compile(r"/\*[ ]*VRO[ ]+ACTION[ ]+START[ ]*\*/(?P<action>.*?)/\*[ ]*VRO[ ]+ACTION[ ]+END[ ]*\*/",
-        re.MULTILINE | re.DOTALL)
-    # get comments and code from action
-    unraw_action_re = re.compile(r"/\*\*(?P<comments>.*?)\*/.*?function[ ]+(?P<function>[\w-]+)[ ]*\(\).*?\{.*?(?P<code>.*?)^\}",
-        re.MULTILINE | re.DOTALL)
-    
+    from action import Action
     actions = []
-    for raw_action in action_re.findall(module_content):
-        act_id = get_id_from_comments(raw_action)
-        unraw_action_m = unraw_action_re.search(raw_action)
-        # test match before continuing: else raise error in logs
-        if unraw_action_m:
-            act_name = unraw_action_m.group('function')
-            act_script = unraw_action_m.group('code').strip()
-            act_comments = unraw_action_m.group('comments')
-            # read description
-            act_desc = get_description_from_comments(act_comments)
-            # find return data
-            act_return = get_return_from_comment(act_comments)
-            # find params
-            act_params = get_params_from_comments(act_comments)
+    for raw in parse_module(module_content, first_line):
+        if not raw['id']:
+            logger.error("Cannot find id of vRO action at line %d of module %s: %s"
+                % (raw['line'], module_name, raw['raw']))
+            exit(-1)
+        # test parse before continuing: else raise error in logs
+        if raw['script'] is not None:
+            act_comments = raw['comments']
             action = Action(
-                id=act_id,
-                name=act_name,
-                description=act_desc,
-                params=act_params,
-                script=act_script,
+                id=raw['id'],
+                name=raw['name'],
+                description=get_description_from_comments(act_comments),
+                params=get_params_from_comments(act_comments),
+                script=raw['script'].strip(),
                 category=module_name,
-                js_result=act_return
+                js_result=get_return_from_comment(act_comments)
             )
-            logger.debug("Found action with name %s and ID %s" % (act_name, act_id))
+            # lazy arguments: only formatted if debug messages are enabled
+            logger.debug("Found action with name %s and ID %s", action.name, action.id)
             actions.append(action)
-            action.xml_render(target)
         else:
             logger.error(
-                "Invalid syntax in following supposed-to-be vRO action: %s" % raw_action)
+                "Invalid syntax in vRO action at line %d of module %s: %s"
+                % (raw['line'], module_name, raw['raw']))
     return actions
 
 
-def list_modules(path):
-    """ Returns a list of modules (name,content) found in a path
+def extract_actions_from_modules(modules, jobs=1):
+    """ Returns actions object of a list of modules (name,content)
+
+    With jobs greater than 1, modules are extracted by a pool of jobs worker
+    processes.
     """
-    modules = []
+    actions = []
+    for module_actions in extract_actions_by_module(modules, jobs):
+        actions.extend(module_actions)
+    return actions
+
+
+def extract_actions_by_module(modules, jobs=1):
+    """ Returns the list of actions of each module of a list of modules
+    (name,content)
+    """
+    module_actions = []
+    progress = Progress("module(s) extracted", len(modules))
+    if jobs <= 1 or len(modules) < 2:
+        for m in modules:
+            module_actions.append(
+                extract_actions_from_module_file(m[0], "".join(m[1][1:]), 2))
+            progress.update()
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        logger.debug("Extracting %d modules with %d processes" % (len(modules), jobs))
+        # the worker processes are forked with the outputs flushed
+        flush_logging()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for actions in executor.map(extract_actions_from_module_file,
+                                        [m[0] for m in modules],
+                                        ["".join(m[1][1:]) for m in modules],
+                                        [2] * len(modules)):
+                module_actions.append(actions)
+                progress.update()
+    progress.done()
+    return module_actions
+
+
+def read_module(file):
+    """ Returns the module (name,content,file) stored in a js file (None if
+    the file is not a module)
+    """
+    with open(file, 'r') as modfile:
+        content = modfile.readlines()
+    m = module_re.search(content[0]) if content else None
+    # test if its supposed to be a module
+    if m and m.group(1):
+        # great its a module ! lets see its content
+        logger.debug("Module detected %s", m.group(1))
+        return (m.group(1), content, file)
+    return None
+
+
+def list_module_files(path):
+    """ Returns the list of js files found in a path
+    """
+    js_files = []
     for root, dirs, files in os.walk(path): # pylint: disable=unused-variable
         for file in files:
             if file.endswith(".js"):
-                with open(os.path.join(path, file), 'r') as modfile:
-                    content = modfile.readlines()
-                    module_re = r"/\*\* @module +([\w.]+) +\*/"
-                    m = re.search(module_re, content[0])
-                    # test if its supposed to be a module
-                    if m and m.group(1):
-                        # great its a module ! lets see its content
-                        logger.debug("Module detected %s" % m.group(1))
-                        modules.append((m.group(1), content))
+                js_files.append(os.path.join(root, file))
+    return js_files
+
+
+def module_mtimes(path):
+    """ Returns the modification time of every js file in path
+    """
+    mtimes = {}
+    for file in list_module_files(path):
+        try:
+            mtimes[file] = os.stat(file).st_mtime_ns
+        except OSError:
+            # removed while listing
+            pass
+    return mtimes
+
+
+def list_modules(path):
+    """ Returns a list of modules (name,content,file) found in a path
+    """
+    modules = []
+    for file in list_module_files(path):
+        module = read_module(file)
+        if module:
+            modules.append(module)
     return modules
@@ -7,9 +7,13 @@ import hashlib
 import io
 import logging
 import re
-from utils import logger, read_config, confirm_action, extract_actions_from_module_file, list_modules
-from package import Package
-from vroserver import VroServer
+import time
+from utils import logger, confirm_action, extract_actions_by_module, \
+    extract_actions_from_module_file, list_modules, module_mtimes, read_module
+from config import read_config, COMPRESSION_MODES
+import profiling
+# package, vroserver and batch (and lxml, jinja2, requests behind them) are
+# imported by the commands using them to keep the startup of the CLI fast
 
 def print_version(ctx, param, value):
     """ Print version of vRO CLI
@@ -31,32 +35,85 @@ def abort_if_false(ctx, param, value):
 @click.option('-v', '--verbose', is_flag=True, default=False)
 @click.option('--version', is_flag=True, callback=print_version,
     expose_value=False, is_eager=True)
-def vrocli(verbose=False):
+@click.option('--profile', is_flag=True, default=False,
+    help="Print the time spent in each stage of the command")
+@click.option('--trace', metavar='<file>',
+    help="Save the timed stages as a Chrome trace file (implies --profile)")
+@click.option('--cprofile', metavar='<file>',
+    help="Profile the command with cProfile and save the stats in file")
+@click.option('--tracemalloc', 'trace_malloc', is_flag=True, default=False,
+    help="Report the peak memory and the main memory allocations")
+@click.pass_context
+def vrocli(ctx, verbose=False, profile=False, trace=None, cprofile=None, trace_malloc=False):
     """ vRealize Automation coder/command line interface
     """
+    global config
+    start = time.time()
+    config = read_config()
+    profiling.record('config load', start, time.time())
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    if config.template_cache:
+        from action import enable_bytecode_cache
+        enable_bytecode_cache(config.template_cache)
+    if profile or trace:
+        profiling.enable()
+        ctx.call_on_close(profiling.summary)
+        if trace:
+            ctx.call_on_close(lambda: profiling.save_trace(trace))
+    if cprofile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        def _dump_cprofile():
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        ctx.call_on_close(_dump_cprofile)
+        profiler.enable()
+    if trace_malloc:
+        import tracemalloc
+        def _report_tracemalloc():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            click.echo("Memory: %.1f MB current, %.1f MB peak" % (current / 1048576.0,
+                       peak / 1048576.0), err=True)
+            for stat in snapshot.statistics('lineno')[:10]:
+                click.echo("  %s" % stat, err=True)
+        ctx.call_on_close(_report_tracemalloc)
+        tracemalloc.start()
 
 
-@vrocli.command('list', options_metavar='',
-                short_help='List configured items (servers or packages)')
+@vrocli.command('list', options_metavar='<options>',
+                short_help='List configured items (servers or packages) or actions')
 @click.argument('itemtype', nargs=1, metavar='<string>')
-def list(itemtype):
-    """ List configured items (servers or packages)
+@click.option('-p', '--package', nargs=1, metavar='<string>',
+    help="Package of the actions to list")
+@click.option('-c', '--category', nargs=1, metavar='<string>',
+    help="Only list the actions of this category (module)")
+@click.option('-a', '--action', nargs=1, metavar='<string>',
+    help="Only list the action with this id or name")
+def list(itemtype, package, category, action):
+    """ List configured items (servers or packages) or the actions of a
+    package (from its index, updated by expand and build)
     """
     lookup = None
     if (itemtype == 'server') or (itemtype == 'servers'):
         lookup = 'vro_servers'
     if (itemtype == 'package') or (itemtype == 'packages'):
         lookup = 'packages'
+    if (itemtype == 'action') or (itemtype == 'actions'):
+        _list_actions(package, category, action)
+        return
     if not lookup:
         logger.error(""" Invalid itemtype to list from configuration: 
-        only 'server'(s)/'package'(s) values are accepted.""")
+        only 'server'(s)/'package'(s)/'action'(s) values are accepted.""")
         exit(-1)
     click.echo("%s configured items are:" % lookup)
-    for item in config[lookup]:
+    for item in getattr(config, lookup):
         click.echo("  > %s" % str(item))
 
 
@@ -66,19 +123,48 @@ def list(itemtype):
     help='Name of vRO server (must be in configuration file)')
 @click.option('-p', '--package', nargs=1, metavar='<string>',
     help="Package name to use (must be in configuration file)")
+@click.option('--servers', nargs=1, metavar='<string>',
+    help='Comma separated list of vRO servers to push to')
+@click.option('-g', '--group', nargs=1, metavar='<string>',
+    help="Group of packages to use (from package_groups configuration)")
+@click.option('--all-packages', is_flag=True, default=False,
+    help="Use all the configured packages")
+@click.option('-j', '--jobs', default=4, metavar='<int>',
+    help="Number of concurrent transfers in batch mode (and of build processes)")
+@click.option('--per-server', default=2, metavar='<int>',
+    help="Maximum number of concurrent transfers per server in batch mode")
 @click.option('-b', '--build', is_flag=True, default=False,
     help="Do you want to build the package from local files before pushing?")
+@click.option('-z', '--compression', type=click.Choice(COMPRESSION_MODES),
+    help="Compression of the actions when building (default: from configuration)")
+@click.option('-f', '--force', is_flag=True, default=False,
+    help="Push the package even if the local state says it is unchanged since the last push")
+@click.option('--check-remote', is_flag=True, default=False,
+    help="Check the package was not changed on the server before skipping the push")
 @click.option('--yes', is_flag=True, callback=abort_if_false,
     expose_value=False,
     prompt='This action will replace your remote work. Continue?')
-def push(package, server, build):
+def push(package, server, servers, group, all_packages, jobs, per_server, build,
+         compression, force, check_remote):
     """ (Optionnaly build and) Push a package to a vRO server
     """
+    from package import Package
+    from vroserver import VroServer
+    from batch import Transfer, run_transfers
+    packages = _packages_from_options(package, group, all_packages)
+    hostnames = _servers_from_options(server, servers)
     if build:
-        _build_package(package)
-    p = Package(package, config)
-    v = VroServer(server, config)
-    v.push(p.name, p.build)
+        _build_packages(packages, jobs=jobs, compression=compression)
+    if len(packages) == 1 and len(hostnames) == 1:
+        p = Package(packages[0], config)
+        v = VroServer(hostnames[0], config)
+        v.push(p.name, p.build, force, check_remote)
+        return
+    vro_servers = [VroServer(h, config) for h in hostnames]
+    transfers = [Transfer('push', Package(name, config), v, force, check_remote)
+                 for name in packages for v in vro_servers]
+    if not run_transfers(transfers, jobs, per_server):
+        exit(-1)
 
 
 @vrocli.command('pull', options_metavar='<options>',
@@ -87,74 +173,411 @@ def push(package, server, build):
     help='Name of vRO server (must be in configuration file)')
 @click.option('-p', '--package', nargs=1, metavar='<string>',
     help="Package name to us (must be in configuration file)")
+@click.option('-g', '--group', nargs=1, metavar='<string>',
+    help="Group of packages to use (from package_groups configuration)")
+@click.option('--all-packages', is_flag=True, default=False,
+    help="Use all the configured packages")
+@click.option('-j', '--jobs', default=4, metavar='<int>',
+    help="Number of concurrent transfers in batch mode (and of expand processes)")
 @click.option('-e', '--expand', is_flag=True, default=False,
     help="Do you want to expand the package to local files after downloading?")
 @click.option('--yes', is_flag=True, callback=abort_if_false,
     expose_value=False,
     prompt='This action will replace any local current work. Continue?')
-def pull(package, server, expand):
+def pull(package, server, group, all_packages, jobs, expand):
     """ Get (and optionnaly expand) a package from a vRO server
     """
-    p = Package(package, config)
-    v = VroServer(server, config)
-    v.pull(p.name, p.src_package)
+    from package import Package
+    from vroserver import VroServer
+    from batch import Transfer, run_transfers
+    packages = _packages_from_options(package, group, all_packages)
+    if len(packages) == 1:
+        p = Package(packages[0], config)
+        v = VroServer(server, config)
+        v.pull(p.name, p.src_package)
+    else:
+        v = VroServer(server, config)
+        transfers = [Transfer('pull', Package(name, config), v) for name in packages]
+        if not run_transfers(transfers, jobs, jobs):
+            exit(-1)
     if expand:
-        _expand_package(package)
+        for name in packages:
+            _expand_package(name, jobs)
 
 
 @vrocli.command('build', options_metavar='<options>',
     short_help='Build a package file from the local files structure')
 @click.option('-p', '--package', nargs=1, metavar='<string>',
     help="Package name to use")
+@click.option('-g', '--group', nargs=1, metavar='<string>',
+    help="Group of packages to use (from package_groups configuration)")
+@click.option('--all', '--all-packages', 'all_packages', is_flag=True, default=False,
+    help="Build all the configured packages")
+@click.option('-z', '--compression', type=click.Choice(COMPRESSION_MODES),
+    help="Compression of the rendered actions (default: from configuration)")
+@click.option('--full', is_flag=True, default=False,
+    help="Render and compress every action, even unchanged ones")
+@click.option('-j', '--jobs', default=1, metavar='<int>',
+    help="Number of processes used to extract and render actions")
 @click.option('--yes', is_flag=True, callback=abort_if_false,
     expose_value=False,
     prompt='This action will built a new package based on local work. Continue?')
-def build_package(package):
+def build_package(package, group, all_packages, compression, full, jobs):
     """ Build a package file from the local files structure
     """
-    _build_package(package)
+    _build_packages(_packages_from_options(package, group, all_packages), full, jobs,
+                    compression)
 
 
 @vrocli.command('expand', options_metavar='<options>',
     short_help='Expand a package file to a local files structure')
 @click.option('-p', '--package', nargs=1, metavar='<string>',
     help="Package name to use")
+@click.option('-j', '--jobs', default=1, metavar='<int>',
+    help="Number of processes used to parse the package elements")
 @click.option('--yes', is_flag=True, callback=abort_if_false,
     expose_value=False,
     prompt='This action will replace any local current work. Continue?')
-def expand_package(package):
+def expand_package(package, jobs):
     """ Expand a package file to a local files structure
     """
-    _expand_package(package)
+    _expand_package(package, jobs)
 
 
-def _build_package(package):
-    """ Build a package file from the local files structure
+@vrocli.command('watch', options_metavar='<options>',
+    short_help='Rebuild (and optionnaly push) a package when its files change')
+@click.option('-p', '--package', nargs=1, metavar='<string>',
+    help="Package name to use")
+@click.option('-s', '--server', nargs=1, metavar='<string>',
+    help='Name of vRO server to push the package to after each build')
+@click.option('-z', '--compression', type=click.Choice(COMPRESSION_MODES),
+    help="Compression of the rendered actions (default: from configuration)")
+@click.option('-i', '--interval', default=0.5, metavar='<float>',
+    help="Delay in seconds between two checks of the files")
+@click.option('-d', '--debounce', default=0.3, metavar='<float>',
+    help="Delay in seconds without changes to wait before building")
+def watch(package, server, compression, interval, debounce):
+    """ Rebuild (and optionnaly push) a package when its files change
     """
-    logger.info("Building package from local content")
-    # new package obj
+    from package import Package
+    from vroserver import VroServer
     p = Package(package, config)
-    # extract action from js src file to xml one
-    for m in list_modules(p.wd):
-        extract_actions_from_module_file(
-            m[0],
-            "".join(m[1][1:]),
-            p.expand_target
-        )
-    p.rebuild()
+    if compression:
+        p.compression = compression
+    v = VroServer(server, config) if server else None
+    manifest = p.read_manifest()
+    # actions of each module file, updated when a file changes
+    actions = {}
+    mtimes = module_mtimes(p.wd)
+    for file in mtimes:
+        actions[file] = _read_module_actions(file)
+    p.rebuild(_all_actions(actions), manifest)
+    p.write_index(actions)
+    logger.info("Watching %s for changes (Ctrl+C to stop)" % p.wd)
+    try:
+        while True:
+            time.sleep(interval)
+            current = module_mtimes(p.wd)
+            if current == mtimes:
+                continue
+            # wait for the end of a burst of saves
+            while True:
+                time.sleep(debounce)
+                latest = module_mtimes(p.wd)
+                if latest == current:
+                    break
+                current = latest
+            start = time.time()
+            changed = [f for f in current if current[f] != mtimes.get(f)]
+            for file in changed:
+                logger.info("Module file changed: %s" % file)
+                # errors (like an action being typed) must not stop watching
+                try:
+                    actions[file] = _read_module_actions(file)
+                except (SystemExit, Exception) as e:
+                    logger.error("Cannot read %s%s, keeping its last valid actions" %
+                                 (file, _error_text(e)))
+                    actions.setdefault(file, [])
+            for file in set(mtimes) - set(current):
+                logger.info("Module file removed: %s" % file)
+                del actions[file]
+            mtimes = current
+            try:
+                p.rebuild(_all_actions(actions), manifest)
+                p.write_index(actions)
+                if v:
+                    v.push(p.name, p.build)
+            except (SystemExit, Exception) as e:
+                logger.error("Build or push failed%s, waiting for the next change" % _error_text(e))
+                continue
+            logger.info("Done in %.2fs" % (time.time() - start))
+    except KeyboardInterrupt:
+        logger.info("Stop watching %s" % p.wd)
+
 
+@vrocli.command('inventory', options_metavar='<options>',
+    short_help='Index the actions and packages of vRO servers and look them up')
+@click.option('-s', '--server', nargs=1, metavar='<string>',
+    help='Name of vRO server to refresh the inventory of')
+@click.option('--servers', nargs=1, metavar='<string>',
+    help='Comma separated list of vRO servers to refresh the inventory of')
+@click.option('-a', '--action', nargs=1, metavar='<string>',
+    help="Show the servers of the action with this id, name or module/name")
+@click.option('-m', '--module', nargs=1, metavar='<string>',
+    help="Show the actions of this module")
+@click.option('-p', '--package', nargs=1, metavar='<string>',
+    help="Show the servers of this package")
+@click.option('-j', '--jobs', default=4, metavar='<int>',
+    help="Number of concurrent requests to each server")
+@click.option('--page-size', type=int, metavar='<int>',
+    help="Number of items requested by page of the server catalog")
+def inventory(server, servers, action, module, package, jobs, page_size):
+    """ Index the actions and packages of vRO servers and look them up
+
+    Only the actions added or changed since the last refresh of a server
+    are fetched again.
+    """
+    from inventory import Inventory
+    if not (server or servers or action or module or package):
+        logger.error("A server to refresh, or an action, module or package to look up is required.")
+        exit(-1)
+    inv = Inventory(config.inventory_file)
+    try:
+        if server or servers:
+            from vroserver import VroServer
+            for hostname in _servers_from_options(server, servers):
+                start = time.time()
+                actions, changed, packages = inv.refresh(VroServer(hostname, config), jobs,
+                                                       page_size)
+                logger.info("Inventory of %s refreshed in %.2fs: %d action(s) (%d fetched), "
+                            "%d package(s)" % (hostname, time.time() - start, actions, changed,
+                                               packages))
+        rows = []
+        if action:
+            rows = inv.find_action(action)
+        elif module:
+            rows = inv.module_actions(module, server if server and not servers else None)
+        for row in rows:
+            click.echo("%-20s %s/%s  %s  %s  %s  %s" % (row['server'], row['module'], row['name'],
+                row['version'], row['id'], (row['checksum'] or '-')[:12],
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(row['last_seen']))))
+        if package:
+            for row in inv.find_package(package):
+                click.echo("%-20s %s  %s  %s" % (row['server'], row['name'], row['version'],
+                    time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(row['last_seen']))))
+    finally:
+        inv.close()
+
+
+@vrocli.command('diff', options_metavar='<options>',
+    short_help='Show the differences between two versions of a package')
+@click.option('-p', '--package', nargs=1, metavar='<string>',
+    help="Package name to use")
+@click.option('-s', '--server', nargs=1, metavar='<string>',
+    help='Compare the package of this vRO server with the local one')
+@click.option('--source', is_flag=True, default=False,
+    help="With --server, compare with the package file instead of the built one")
+@click.option('-u', '--unified', is_flag=True, default=False,
+    help="Show the changed fields of the actions (and a unified diff of their script)")
+@click.argument('files', nargs=-1, metavar='[<old file> <new file>]',
+    type=click.Path(exists=True, dir_okay=False))
+def diff_package(package, server, source, unified, files):
+    """ Show the differences between two versions of a package
 
-def _expand_package(package):
+    Compare the package file of a package with its built one, the package
+    of a vRO server with the built (or --source) one, or two package files.
+    Only the elements whose entries differ in the zip central directories
+    are read and compared.
+    """
+    import shutil
+    from diff import diff_packages
+    tmp_dir = None
+    try:
+        if files:
+            if len(files) != 2 or package or server:
+                logger.error("Either two package files or a package are required.")
+                exit(-1)
+            old, new = files
+            old_label, new_label = files
+        else:
+            from package import Package
+            if not package:
+                logger.error("A package (or two package files) is required.")
+                exit(-1)
+            p = Package(package, config)
+            new = new_label = p.src_package if source else p.build
+            if server:
+                import tempfile
+                from vroserver import VroServer
+                if not os.path.isfile(new):
+                    logger.error("Package not found %s" % new)
+                    exit(-1)
+                tmp_dir = tempfile.mkdtemp(prefix='vrocli-diff-')
+                old = os.path.join(tmp_dir, p.name + '.package')
+                VroServer(server, config).pull(p.name, old)
+                old_label = "%s:%s" % (server, p.name)
+            elif source:
+                logger.error("--source requires a server to compare with.")
+                exit(-1)
+            else:
+                old = old_label = p.src_package
+            for file in (old, new):
+                if not os.path.isfile(file):
+                    logger.error("Package not found %s" % file)
+                    exit(-1)
+        start = time.time()
+        with profiling.stage('diff'):
+            diffs, unchanged = diff_packages(old, new)
+        click.echo("--- %s" % old_label)
+        click.echo("+++ %s" % new_label)
+        for d in diffs:
+            click.echo(d.describe())
+            if unified:
+                for line in d.details(old_label, new_label):
+                    click.echo(line)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    logger.info("%d added, %d removed, %d changed element(s), %d rebuilt without changes "
+                "(%.2fs)" % (len([d for d in diffs if d.status == 'added']),
+                             len([d for d in diffs if d.status == 'removed']),
+                             len([d for d in diffs if d.status == 'changed']),
+                             unchanged, time.time() - start))
+
+
+def _list_actions(package, category, action):
+    """ Print the actions of a package found in its index
+    """
+    from package import Package
+    if not package:
+        logger.error("A package is required to list actions.")
+        exit(-1)
+    index = Package(package, config).read_index()
+    if action:
+        actions = index.find(action)
+    elif category:
+        actions = index.category(category)
+    else:
+        actions = sorted(index.actions.items(),
+                         key=lambda a: (a[1]['category'], a[1]['name']))
+    for action_id, entry in actions:
+        if category and entry['category'] != category:
+            continue
+        click.echo("%s  %s.%s  %s" % (action_id, entry['category'], entry['name'],
+                                      entry['file']))
+
+
+def _read_module_actions(file):
+    """ Returns the actions of a module file
+    """
+    try:
+        module = read_module(file)
+    except OSError:
+        return []
+    if not module:
+        return []
+    return extract_actions_from_module_file(module[0], "".join(module[1][1:]), 2)
+
+
+def _error_text(error):
+    """ Returns the description of an error caught while watching (the
+    message of exit(-1) calls is already logged)
+    """
+    if isinstance(error, SystemExit):
+        return ""
+    return ": %s" % error
+
+
+def _all_actions(actions):
+    """ Returns the actions of all the module files, in a stable order
+    """
+    return [a for file in sorted(actions) for a in actions[file]]
+
+
+def _packages_from_options(package, group, all_packages):
+    """ Returns the list of package names selected by the command options
+    """
+    if all_packages:
+        return [name for name in config.packages]
+    if group:
+        try:
+            return config.package_groups[group]
+        except KeyError:
+            logger.error("Package group %s is not configured." % group)
+            exit(-1)
+    if not package:
+        logger.error("A package, a group of packages or --all-packages is required.")
+        exit(-1)
+    return [package]
+
+
+def _servers_from_options(server, servers):
+    """ Returns the list of server names selected by the command options
+    """
+    if servers:
+        return [s.strip() for s in servers.split(',') if s.strip()]
+    if not server:
+        logger.error("A server or a list of servers is required.")
+        exit(-1)
+    return [server]
+
+
+def _build_packages(packages, full=False, jobs=1, compression=None):
+    """ Build package files from their local files structure
+
+    Unless full is set, only the actions changed since the previous build
+    are rendered and compressed again. Module files of all the packages are
+    read first and extracted by one pool of processes (modules found in
+    several working directories are extracted once), and actions found in
+    several packages are rendered and compressed once.
+    """
+    from package import Package, SharedElements
+    logger.info("Building %d package(s) from local content" % len(packages))
+    # new package objs
+    packages = [Package(name, config) for name in packages]
+    if compression:
+        for p in packages:
+            p.compression = compression
+    # extract actions from js src files
+    with profiling.stage('list_modules') as counts:
+        modules = {}
+        for p in packages:
+            if p.wd not in modules:
+                modules[p.wd] = list_modules(p.wd)
+        counts['files'] = sum(len(m) for m in modules.values())
+    with profiling.stage('extraction') as counts:
+        unique = {}
+        for wd_modules in modules.values():
+            for m in wd_modules:
+                unique.setdefault((m[0], "".join(m[1])), m)
+        keys = [k for k in unique]
+        extracted = dict(zip(keys, extract_actions_by_module([unique[k] for k in keys],
+                                                             jobs=jobs)))
+        counts['actions'] = sum(len(a) for a in extracted.values())
+    # and put them in a copy of each package file
+    shared = SharedElements()
+    try:
+        for p in packages:
+            actions = [a for m in modules[p.wd] for a in extracted[(m[0], "".join(m[1]))]]
+            manifest = {'actions': {}} if full else p.read_manifest()
+            p.rebuild(actions, manifest, shared if len(packages) > 1 else None, jobs)
+            p.write_index(dict((m[2], extracted[(m[0], "".join(m[1]))]) for m in modules[p.wd]))
+    finally:
+        shared.close()
+
+
+def _expand_package(package, jobs=1):
     """ Expand a package file to a local files structure
     """
+    from package import Package
     # new package obj
     p = Package(package, config)
-    # unzip
-    p.unzip()
+    if p.is_expanded():
+        logger.info("Package %s is already expanded in %s" % (p.name, p.wd))
+        return
     # convert to js files
-    p.expand()
+    p.expand(jobs)
 
 
 if __name__ == '__main__':
-    config = read_config()
     vrocli()
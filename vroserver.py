@@ -2,66 +2,561 @@
 
 import requests
 import os
-from utils import confirm_action, logger
+import time
+import hashlib
+import json
+import zipfile
+import shutil
+import binascii
+from utils import confirm_action, flush_logging, logger
+import profiling
+from state import get_state, package_fingerprint, changed_entries
+from cache import get_cache
 import getpass
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError
+
+# size of the chunks read from/written to the network
+CHUNK_SIZE = 1024 * 1024
+# minimal delay (in seconds) between two progress reports
+PROGRESS_INTERVAL = 2
+# number of items per page of the catalog listings
+CATALOG_PAGE_SIZE = 500
+# HTTP status codes of the requests worth sending again
+RETRY_STATUSES = (502, 503, 504)
+
+# HTTP sessions shared by all VroServer objects, by hostname
+_sessions = {}
+_sessions_lock = threading.Lock()
 
 # disable ssl warnings
 requests.packages.urllib3.disable_warnings()
 
 
+class SessionAuth(requests.auth.HTTPBasicAuth):
+    """ Basic authentication only sent until the server opens a session (the
+    JSESSIONID cookie of vRO): the next requests are authenticated by the
+    cookie. A request refused because the session expired is sent again
+    with the credentials.
+    """
+    def __call__(self, r):
+        if 'JSESSIONID=' not in r.headers.get('Cookie', ''):
+            return super().__call__(r)
+        r.register_hook('response', self._handle_401)
+        return r
+
+
+    def _handle_401(self, r, **kwargs):
+        body = r.request.body
+        if r.status_code != requests.codes.unauthorized or \
+                not (body is None or isinstance(body, bytes) or hasattr(body, 'rewind')):
+            return r
+        logger.debug("Session expired on %s, authenticating again" % r.url)
+        if hasattr(body, 'rewind'):
+            body.rewind()
+        # release the connection before sending the request again
+        r.content
+        r.close()
+        request = r.request.copy()
+        del request.headers['Cookie']
+        super().__call__(request)
+        retry = r.connection.send(request, **kwargs)
+        retry.history.append(r)
+        retry.request = request
+        return retry
+
+
+class DownloadInterrupted(Exception):
+    """ A download broken after the response was received: the requests
+    which fail before are retried by the session, not this one
+    """
+
+
 class VroServer():
     def __init__(self, name, config):
         self.hostname = name
         server_conf = self.is_configured(config)
-        self.username = server_conf.get('user', None)
+        self.username = server_conf.user
+        if not (self.username and server_conf.pwd):
+            flush_logging()
         if not self.username:
             self.username = input('vRO API username: ')
-        self.password = server_conf.get('pwd', None)
+        self.password = server_conf.pwd
         if not self.password:
             self.password = getpass.getpass("vRO API password: ")
-        self.verify_ssl = server_conf.get('verify_ssl', True)
+        self.verify_ssl = server_conf.verify_ssl
+        self.url = "%s://%s/vco/api" % (server_conf.protocol, self.hostname)
+        self.retries = server_conf.retries
+        self.pool_size = server_conf.pool_size
+        self.timeout = server_conf.timeout
+        self.session = self.get_session()
+        self.state = get_state(config)
+        self.cache = get_cache(config)
 
 
     def is_configured(self, config):
         try:
-            return config['vro_servers'][self.hostname]
+            return config.vro_servers[self.hostname]
         except KeyError:
             logger.error("vRO Server %s is not configured. Ensure to add it to your local configuration before to use it."
                 % self.hostname)
             exit(-1)
 
 
+    def get_session(self):
+        """ Returns the persistent HTTP session used to talk to the server
+
+        Sessions are shared between the VroServer objects of a same host so
+        connections (and TLS handshakes) are reused through a pool of
+        keep-alive connections. Cookies set by the server are kept, and the
+        credentials are only sent until vRO opens a session (SessionAuth).
+        """
+        with _sessions_lock:
+            session = _sessions.get(self.hostname)
+            if session is None:
+                session = requests.Session()
+                retry = Retry(total=self.retries, backoff_factor=0.5,
+                              status_forcelist=RETRY_STATUSES,
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      max_retries=retry)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[self.hostname] = session
+            session.auth = SessionAuth(self.username, self.password)
+        return session
+
+
     def pull(self, package_name, destination):
+        """ Download a package from the vRO server to destination
+
+        Content is streamed to a temporary .part file which is renamed over
+        destination once complete. An existing .part file (from a previous
+        interrupted download) is resumed with an HTTP Range request, sent
+        with the validators of the part file (If-Range) so a package changed
+        since is downloaded again. A download interrupted while the package
+        is received is resumed up to retries times (the requests which get
+        no response are retried by the session).
+        If the package is in the local cache, the request is conditional and
+        the cached copy is used when the server answers it is unchanged.
+        Returns True if the content of destination changed.
+        """
+        part = destination + '.part'
+        dest_dir = os.path.dirname(destination)
+        if dest_dir and not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        previous = _fingerprint_or_none(destination)
+        entry = self.cache.lookup(self.hostname, package_name) if self.cache else None
+        conditional = {}
+        if entry and not os.path.isfile(part):
+            if entry['etag']:
+                conditional['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                conditional['If-Modified-Since'] = entry['last_modified']
+        logger.info("Downloading package data from %s to %s " %
+                    (self.hostname, destination))
+        with profiling.stage('HTTP transfer') as counts:
+            for attempt in range(1, self.retries + 2):
+                try:
+                    result = self._download(package_name, part, conditional)
+                    break
+                except DownloadInterrupted as e:
+                    if attempt > self.retries:
+                        logger.error("Download failed after %d attempts: %s" % (attempt, e))
+                        exit(-1)
+                    logger.warning("Download interrupted (%s), resuming (attempt %d/%d)"
+                        % (e, attempt, self.retries))
+                except requests.exceptions.RequestException as e:
+                    # already retried by the session
+                    logger.error("Download failed: %s" % e)
+                    exit(-1)
+            counts['bytes'] = result[0] if result else 0
+        if result is None:
+            logger.info("Package %s is unchanged on %s, using cached copy" %
+                        (package_name, self.hostname))
+            blob = self.cache.blob_path(entry['sha256'])
+            fingerprint, entries = package_fingerprint(blob)
+            if fingerprint != previous:
+                shutil.copyfile(blob, part)
+                os.replace(part, destination)
+            self.state.set(self.hostname, package_name, fingerprint, entries,
+                           self.package_checksum(package_name))
+            return fingerprint != previous
+        size, total, checksum, validators = result
+        if total is not None and size != total:
+            logger.error("Incomplete download: got %d bytes, expected %d" % (size, total))
+            exit(-1)
+        if not zipfile.is_zipfile(part):
+            os.remove(part)
+            logger.error("Downloaded content is not a valid package archive")
+            exit(-1)
+        os.replace(part, destination)
+        logger.info("Package downloaded: %s (sha256: %s)" % (_human_size(size), checksum))
+        if self.cache:
+            self.cache.add(self.hostname, package_name, destination, checksum, *validators)
+        fingerprint, entries = package_fingerprint(destination)
+        self.state.set(self.hostname, package_name, fingerprint, entries,
+                       self.package_checksum(package_name))
+        return fingerprint != previous
+
+
+    def _download(self, package_name, part, conditional=None):
+        """ Stream the package to the part file, resuming it if it exists
+
+        Returns the size of the part file, the expected size (if known), the
+        sha256 of the content and the ETag and Last-Modified validators of
+        the response, or None if the server answered to the conditional
+        headers that the package is not modified.
+        """
         headers = {'accept': 'application/zip'}
-        r = requests.get("https://%s/vco/api/packages/%s" % (self.hostname, package_name),
-                auth = (self.username, self.password),
+        sha = hashlib.sha256()
+        offset = 0
+        validators_file = part + '.validators'
+        if os.path.isfile(part):
+            validators = _read_validators(validators_file)
+            if validators:
+                # the range is only sent if the package did not change since
+                # the part file was started, else the whole package is sent
+                offset = os.path.getsize(part)
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = validators[0] or validators[1]
+            else:
+                logger.debug("Cannot resume download without validators, restarting it")
+                os.remove(part)
+        if not offset and conditional:
+            headers.update(conditional)
+        r = self.session.get("%s/packages/%s" % (self.url, package_name),
                 headers = headers,
-                verify = self.verify_ssl
+                verify = self.verify_ssl,
+                timeout = self.timeout,
+                stream = True
             )
-        #r.raise_for_status()
+        with r:
+            if r.status_code == requests.codes.not_modified:
+                return None
+            if r.status_code == requests.codes.requested_range_not_satisfiable:
+                # part file is not usable anymore: start from scratch
+                logger.debug("Cannot resume download, restarting it")
+                os.remove(part)
+                _remove_if_exists(validators_file)
+                return self._download(package_name, part, conditional)
+            if r.status_code == requests.codes.partial_content:
+                logger.info("Resuming download at %s" % _human_size(offset))
+                mode = 'ab'
+                with open(part, 'rb') as partfile:
+                    for chunk in iter(lambda: partfile.read(CHUNK_SIZE), b''):
+                        sha.update(chunk)
+            elif r.status_code == requests.codes.ok:
+                mode = 'wb'
+                offset = 0
+                # validators of the content, to resume it if interrupted
+                _write_validators(validators_file, (r.headers.get('ETag'),
+                                                    r.headers.get('Last-Modified')))
+            else:
+                logger.error("Bad HTTP response code: %d" % r.status_code)
+                exit(-1)
+            total = None
+            if 'Content-Length' in r.headers:
+                total = offset + int(r.headers['Content-Length'])
+            size = offset
+            start = last_report = time.time()
+            with open(part, mode) as outfile:
+                try:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        outfile.write(chunk)
+                        sha.update(chunk)
+                        size += len(chunk)
+                        if time.time() - last_report >= PROGRESS_INTERVAL:
+                            last_report = time.time()
+                            _report_progress(size, total, size - offset, last_report - start)
+                except requests.exceptions.RequestException as e:
+                    raise DownloadInterrupted(e)
+            _report_progress(size, total, size - offset, time.time() - start)
+        _remove_if_exists(validators_file)
+        validators = (r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return size, total, sha.hexdigest(), validators
+
+
+    def package_checksum(self, package_name):
+        """ Returns the checksum of the description of a package on the
+        server (its JSON: id, version, elements...), None if the package is
+        not on the server
+        """
+        r = self.session.get("%s/packages/%s" % (self.url, package_name),
+                headers = {'accept': 'application/json'},
+                verify = self.verify_ssl,
+                timeout = self.timeout
+            )
+        if r.status_code == requests.codes.not_found:
+            return None
         if not r.status_code == requests.codes.ok:
             logger.error("Bad HTTP response code: %d" % r.status_code)
             exit(-1)
-        logger.info("Downloading package data from %s to %s " %
-                    (self.hostname, destination))
-        open(destination, 'wb').write(r.content)
-
-
-    def push(self, package_name, file_location):
-        #headers = {'accept': 'application/zip'}
-        files = {'file': ('%s.package' % package_name,
-                            open(file_location, 'rb'),
-                            'application/zip',
-                            {'Expires': '0'})
-                }
-        r = requests.post("https://%s/vco/api/packages/?overwrite=true" % self.hostname,
-                auth = (self.username, self.password),
+        return hashlib.sha1(json.dumps(r.json(), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    def catalog(self, item_type, page_size=None, jobs=4):
+        """ Returns the attributes (a dict) of every item of a type of the
+        vRO catalog (like Action or Package)
+
+        The first page gives the number of items, the other pages are then
+        requested by jobs concurrent requests.
+        """
+        page_size = page_size or CATALOG_PAGE_SIZE
+        items, total = self._catalog_page(item_type, 0, page_size)
+        starts = range(page_size, total, page_size)
+        if starts:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for page in executor.map(
+                        lambda start: self._catalog_page(item_type, start, page_size)[0],
+                        starts):
+                    items.extend(page)
+        logger.debug("%d %s item(s) listed on %s" % (len(items), item_type, self.hostname))
+        return items
+
+
+    def _catalog_page(self, item_type, start, page_size):
+        """ Returns the items of a page of the catalog and the total number
+        of items
+        """
+        r = self.session.get("%s/catalog/System/%s" % (self.url, item_type),
+                params = {'maxResult': page_size, 'startIndex': start, 'queryCount': 'true'},
+                headers = {'accept': 'application/json'},
+                verify = self.verify_ssl,
+                timeout = self.timeout
+            )
+        if not r.status_code == requests.codes.ok:
+            logger.error("Bad HTTP response code: %d" % r.status_code)
+            exit(-1)
+        content = r.json()
+        items = [dict((a['name'], a.get('value')) for a in link.get('attributes', []))
+                 for link in content.get('link', [])]
+        return items, content.get('total', len(items))
+
+
+    def get_action(self, action_id):
+        """ Returns the content of an action (script, parameters...)
+        """
+        r = self.session.get("%s/actions/%s" % (self.url, action_id),
+                headers = {'accept': 'application/json'},
                 verify = self.verify_ssl,
-                files = files
+                timeout = self.timeout
             )
+        if not r.status_code == requests.codes.ok:
+            logger.error("Bad HTTP response code: %d" % r.status_code)
+            exit(-1)
+        return r.json()
+
+
+    def push(self, package_name, file_location, force=False, check_remote=False,
+             retries=0, backoff=2):
+        """ Push a package file to the server
+
+        The push is skipped if the same content was already pushed to (or
+        pulled from) the server according to the local state, unless force
+        is set. With check_remote, the description of the package on the
+        server must also be the one recorded then (so a package changed on
+        the server since is pushed again).
+        An upload answered by a 502/503/504 or broken while sending is sent
+        again up to retries times, after backoff ** attempt seconds (the
+        session does not retry the uploads).
+        Returns True if the package was pushed.
+        """
+        if not os.path.isfile(file_location):
+            logger.error("Package file not found %s" % file_location)
+            exit(-1)
+        fingerprint, entries = package_fingerprint(file_location)
+        known = self.state.get(self.hostname, package_name)
+        if known and not force:
+            if known['fingerprint'] != fingerprint:
+                changed = changed_entries(known['entries'], entries)
+                logger.info("%d package entries changed since last push to %s" %
+                            (len(changed), self.hostname))
+            elif not check_remote:
+                logger.info("Package %s is unchanged since its transfer with %s on %s "
+                            "(according to the local state), skipping push" %
+                            (package_name, self.hostname, known['date']))
+                return False
+            else:
+                remote = self.package_checksum(package_name)
+                if remote is not None and remote == known.get('remote'):
+                    logger.info("Package %s is unchanged on %s since %s, skipping push" %
+                                (package_name, self.hostname, known['date']))
+                    return False
+                logger.info("Package %s changed on %s since %s, pushing it again" %
+                            (package_name, self.hostname, known['date']))
+        logger.info("Uploading package %s to %s" % (file_location, self.hostname))
+        with MultipartUpload('file', '%s.package' % package_name, file_location,
+                             'application/zip', {'Expires': '0'}) as body, \
+                profiling.stage('HTTP transfer', bytes=len(body)):
+            for attempt in range(1, retries + 2):
+                try:
+                    r = self.session.post("%s/packages/?overwrite=true" % self.url,
+                            headers = {'Content-Type': body.content_type},
+                            verify = self.verify_ssl,
+                            data = body,
+                            timeout = self.timeout
+                        )
+                    if r.status_code not in RETRY_STATUSES or attempt > retries:
+                        break
+                    error = "HTTP %d" % r.status_code
+                except requests.exceptions.ConnectionError as e:
+                    # the connection itself is already retried by the session
+                    if attempt > retries or (e.args and isinstance(e.args[0], MaxRetryError)):
+                        raise
+                    error = e
+                delay = backoff ** attempt
+                logger.warning("Upload of %s to %s failed (%s), retrying in %ds" %
+                               (package_name, self.hostname, error, delay))
+                time.sleep(delay)
+                body.rewind()
+            body.report_progress()
         #r.raise_for_status()
         if not r.status_code == requests.codes.accepted:
             logger.error("Bad HTTP response code: %d" % r.status_code)
             exit(-1)
         logger.info("Pushed %s package content to %s" % 
                     (package_name, self.hostname))
+        self.state.set(self.hostname, package_name, fingerprint, entries,
+                       self.package_checksum(package_name))
+        return True
+
+
+class MultipartUpload():
+    """ multipart/form-data body sending a file, read by chunks
+
+    requests streams file-like bodies (with a Content-Length computed from
+    len()) instead of encoding them in memory like with files=, so the
+    upload starts at once and its memory use does not depend on the size
+    of the file.
+    """
+    def __init__(self, field, filename, file_location, content_type, headers=None):
+        self.boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        part_headers = ['Content-Disposition: form-data; name="%s"; filename="%s"'
+                        % (field, filename),
+                        'Content-Type: %s' % content_type]
+        part_headers += ['%s: %s' % h for h in (headers or {}).items()]
+        self.preamble = ('--%s\r\n%s\r\n\r\n' % (self.boundary, '\r\n'.join(part_headers))
+                         ).encode('utf-8')
+        self.epilogue = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self.size = os.path.getsize(file_location)
+        self.file = open(file_location, 'rb')
+        self.sent = 0
+        self.start = self.last_report = time.time()
+
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+
+    def __len__(self):
+        return len(self.preamble) + self.size + len(self.epilogue)
+
+
+    def read(self, size=-1):
+        """ Returns the next size bytes of the body
+        """
+        if size is None or size < 0:
+            size = len(self) - self.sent
+        chunk = b''
+        if self.sent < len(self.preamble):
+            chunk = self.preamble[self.sent:self.sent + size]
+        if len(chunk) < size:
+            chunk += self.file.read(min(size - len(chunk), CHUNK_SIZE))
+        file_end = len(self.preamble) + self.size
+        if len(chunk) < size and self.sent + len(chunk) >= file_end:
+            offset = self.sent + len(chunk) - file_end
+            chunk += self.epilogue[offset:offset + size - len(chunk)]
+        self.sent += len(chunk)
+        if time.time() - self.last_report >= PROGRESS_INTERVAL:
+            self.report_progress()
+        return chunk
+
+
+    def rewind(self):
+        """ Start the body again, to send the request again
+        """
+        self.file.seek(0)
+        self.sent = 0
+        self.start = self.last_report = time.time()
+
+
+    def report_progress(self):
+        self.last_report = time.time()
+        _report_progress(self.sent, len(self), self.sent, self.last_report - self.start)
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_validators(validators_file):
+    """ Returns the (ETag, Last-Modified) validators of a part file, None if
+    they are unknown
+    """
+    try:
+        with open(validators_file, 'r') as infile:
+            validators = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(validators, list) or len(validators) != 2 or not any(validators):
+        return None
+    return validators
+
+
+def _write_validators(validators_file, validators):
+    if any(validators):
+        with open(validators_file, 'w') as outfile:
+            json.dump(list(validators), outfile)
+    else:
+        _remove_if_exists(validators_file)
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _fingerprint_or_none(package_file):
+    """ Returns the fingerprint of a package file (None if it is not valid)
+    """
+    try:
+        return package_fingerprint(package_file)[0]
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
+def _human_size(size):
+    """ Returns a human readable version of a size in bytes
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return "%.1f %s" % (size, unit)
+
+
+def _report_progress(size, total, transferred, elapsed):
+    """ Log progress and throughput of a transfer
+    """
+    rate = transferred / elapsed if elapsed > 0 else 0
+    if total:
+        logger.info("%s / %s (%d%%) at %s/s" % (_human_size(size), _human_size(total),
+                    size * 100 / total, _human_size(rate)))
+    else:
+        logger.info("%s at %s/s" % (_human_size(size), _human_size(rate)))